@@ -1,13 +1,22 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
+import functools
+import itertools
 import json
 from pathlib import Path
-from typing import Union, Dict, TextIO
+from typing import Union, Dict, Iterable, Iterator, List, Mapping, Optional, \
+    Sequence, TextIO
 
 from lm_zoo import get_registry, spec, tokenize, unkify, get_surprisals
 from lm_zoo.models import Model, HuggingFaceModel
 import pandas as pd
 
 from syntaxgym import utils
-from syntaxgym.agg_surprisals import aggregate_surprisals
+from syntaxgym.agg_surprisals import aggregate_surprisals, \
+    compute_sentence_mappings, reaggregate_surprisals
+from syntaxgym.cache import AlignmentCache, SurprisalCache
+from syntaxgym.scoring import score_sentences, slice_surprisals
+from syntaxgym.sidecar import Sidecar
 from syntaxgym.suite import Suite
 
 __version__ = "0.8a1"
@@ -27,7 +36,13 @@ def _load_suite(suite_ref: Union[str, Path, TextIO, Dict, Suite]) -> Suite:
     return Suite.from_dict(suite)
 
 
-def compute_surprisals(model: Model, suite) -> Suite:
+def compute_surprisals(model: Model, suite, dedup=True,
+                       cache: Optional[SurprisalCache] = None,
+                       single_pass=False, shards: Optional[int] = None,
+                       executor: Optional[Executor] = None,
+                       alignment_cache: Optional[AlignmentCache] = None,
+                       sidecar: Optional[Union[str, Path]] = None,
+                       alignment_workers: int = 1) -> Suite:
     """
     Compute per-region surprisals for a language model on the given suite.
 
@@ -35,26 +50,236 @@ def compute_surprisals(model: Model, suite) -> Suite:
         model: An LM Zoo ``Model``.
         suite_file: A path or open file stream to a suite JSON file, or an
             already loaded suite dict
+        dedup: If ``True``, score each unique sentence in the suite only once.
+        cache: An optional persistent
+            :class:`~syntaxgym.cache.SurprisalCache`. Only sentences missing
+            from the cache are sent to the model.
+        single_pass: If ``True``, read model tokens from the surprisal output
+            rather than running a separate ``tokenize`` pass over the data.
+        shards: If greater than 1, split the suite's items into this many
+            shards, and score and align each shard in parallel.
+        executor: A ``concurrent.futures.Executor`` used to process shards.
+            By default, a process pool with one worker per shard is used.
+        alignment_cache: An optional persistent
+            :class:`~syntaxgym.cache.AlignmentCache` of token-to-region
+            alignments.
+        sidecar: If not ``None``, also write token-level surprisals and
+            region segments to a :class:`~syntaxgym.sidecar.Sidecar` file at
+            this path, from which metrics can be recomputed with
+            :func:`reaggregate`. Not supported with ``shards``.
+        alignment_workers: Maximum number of processes used to align tokens
+            with regions. See :func:`~syntaxgym.agg_surprisals.prepare_sentences`.
+            Ignored with ``shards``, where each shard is aligned serially
+            within its own worker.
 
     Returns:
         An evaluated test suite dict --- a copy of the data from
         ``suite_file``, now including per-region surprisal data
     """
-    suite = _load_suite(suite)
+    kwargs = dict(dedup=dedup, cache=cache, single_pass=single_pass,
+                  alignment_cache=alignment_cache)
+    if shards is not None and shards > 1:
+        if sidecar is not None:
+            raise ValueError("Sidecar output is not supported with shards")
+        # Shards already run in parallel; don't nest process pools.
+        return _compute_surprisals_sharded(model, _load_suite(suite), shards,
+                                           executor, **kwargs)
+
+    kwargs["alignment_workers"] = alignment_workers
+
+    return compute_surprisals_many(
+        model, [suite], sidecars=[sidecar] if sidecar is not None else None,
+        **kwargs)[0]
+
+
+def _compute_surprisals_sharded(model: Model, suite: Suite, shards: int,
+                                executor: Optional[Executor] = None,
+                                **kwargs) -> Suite:
+    """
+    Compute per-region surprisals by splitting ``suite`` into ``shards``
+    sub-suites, processing each in parallel, and merging the results.
+    """
+    shard_size = max(1, -(-len(suite.items) // shards))
+    shard_suites = list(suite.iter_chunks(shard_size))
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=len(shard_suites))
+    try:
+        futures = [executor.submit(compute_surprisals, model, shard, **kwargs)
+                   for shard in shard_suites]
+        results = [future.result() for future in futures]
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    return Suite(condition_names=suite.condition_names,
+                 region_names=suite.region_names,
+                 items=[item for result in results for item in result.items],
+                 predictions=suite.predictions,
+                 meta=results[0].meta if results else deepcopy(suite.meta))
+
+
+def compute_surprisals_many(model: Model, suites: Iterable, dedup=True,
+                            cache: Optional[SurprisalCache] = None,
+                            single_pass=False,
+                            alignment_cache: Optional[AlignmentCache] = None,
+                            sidecars: Optional[Sequence[Union[str, Path]]] = None,
+                            alignment_workers: int = 1
+                            ) -> List[Suite]:
+    """
+    Compute per-region surprisals for a language model on many suites at once.
+
+    Sentences from all suites are scored with a single model invocation, so
+    that model startup costs are paid once rather than once per suite.
+
+    Args:
+        model: An LM Zoo ``Model``.
+        suites: A sequence of suites. Each may be a path or open file stream
+            to a suite JSON file, an already loaded suite dict, or a
+            :class:`~syntaxgym.suite.Suite`.
+        dedup: If ``True``, score each unique sentence across all suites only
+            once.
+        cache: An optional persistent
+            :class:`~syntaxgym.cache.SurprisalCache`. Only sentences missing
+            from the cache are sent to the model.
+        single_pass: If ``True``, read model tokens from the surprisal output
+            rather than running a separate ``tokenize`` pass over the data.
+        alignment_cache: An optional persistent
+            :class:`~syntaxgym.cache.AlignmentCache` of token-to-region
+            alignments.
+        sidecars: Optional paths, one per suite, to which token-level outputs
+            are written. See :func:`compute_surprisals`.
+        alignment_workers: Maximum number of processes used to align tokens
+            with regions. See :func:`~syntaxgym.agg_surprisals.prepare_sentences`.
+
+    Returns:
+        A list of evaluated test suites, in the same order as ``suites``
+    """
+    suites = [_load_suite(suite) for suite in suites]
+    if sidecars is not None and len(sidecars) != len(suites):
+        raise ValueError("Expected one sidecar path per suite")
+    suite_sentences = [list(suite.iter_sentences()) for suite in suites]
+    return _compute_surprisals_loaded(model, suites, suite_sentences,
+                                      dedup=dedup, cache=cache,
+                                      single_pass=single_pass,
+                                      alignment_cache=alignment_cache,
+                                      sidecars=sidecars,
+                                      alignment_workers=alignment_workers)
+
+
+def _compute_surprisals_loaded(model: Model, suites: List[Suite],
+                               suite_sentences: List[List[str]],
+                               **kwargs) -> List[Suite]:
+    """
+    Compute per-region surprisals for already loaded suites, given the
+    sentences of each suite. Keyword arguments other than ``alignment_cache``,
+    ``sidecars`` and ``alignment_workers`` are passed on to
+    :func:`~syntaxgym.scoring.score_sentences`.
+    """
+    agg_kwargs = _pop_aggregate_kwargs(kwargs)
+    all_sentences = list(itertools.chain.from_iterable(suite_sentences))
+    surprisals_df, tokens = score_sentences(model, all_sentences, **kwargs)
+    return _aggregate_loaded(model, suites, suite_sentences, surprisals_df,
+                             tokens, **agg_kwargs)
+
 
-    # Convert to sentences
-    suite_sentences = list(suite.iter_sentences())
+def _pop_aggregate_kwargs(kwargs: dict) -> dict:
+    """
+    Remove the keyword arguments of :func:`_aggregate_loaded` from ``kwargs``,
+    leaving only those for :func:`~syntaxgym.scoring.score_sentences`.
+    """
+    return {key: kwargs.pop(key) for key in
+            ("alignment_cache", "sidecars", "alignment_workers")
+            if key in kwargs}
+
+
+def _aggregate_loaded(model: Model, suites: List[Suite],
+                      suite_sentences: List[List[str]],
+                      surprisals_df: pd.DataFrame, tokens: List[List[str]],
+                      alignment_cache: Optional[AlignmentCache] = None,
+                      sidecars: Optional[Sequence[Union[str, Path]]] = None,
+                      alignment_workers: int = 1) -> List[Suite]:
+    """
+    Aggregate model outputs for the concatenated sentences of already loaded
+    suites into per-region surprisals for each suite.
+    """
+    sidecars = sidecars or [None] * len(suites)
+
+    # Split model outputs back up by suite and aggregate each separately.
+    results = []
+    start = 0
+    for suite, sentences, sidecar in zip(suites, suite_sentences, sidecars):
+        n = len(sentences)
+        results.append(aggregate_surprisals(
+            model, slice_surprisals(surprisals_df, start, n),
+            tokens[start:start + n], suite, alignment_cache=alignment_cache,
+            sidecar=sidecar, alignment_workers=alignment_workers))
+        start += n
+
+    return results
+
+
+def iter_compute_surprisals(model: Model, suite, chunk_size=1000, **kwargs
+                            ) -> Iterator[Suite]:
+    """
+    Compute per-region surprisals for a language model on the given suite,
+    processing ``chunk_size`` items at a time. The suite itself is loaded in
+    full up front, but model outputs and token alignments are only held for
+    one chunk at a time, so their share of peak memory use depends on the
+    chunk size rather than the size of the suite.
+
+    Each chunk is sent to the model separately, so smaller chunks mean more
+    model invocations.
 
-    # First compute surprisals
-    surprisals_df = get_surprisals(model, suite_sentences)
+    Args:
+        model: An LM Zoo ``Model``.
+        suite: A path or open file stream to a suite JSON file, an already
+            loaded suite dict, or a :class:`~syntaxgym.suite.Suite`.
+        chunk_size: Maximum number of items to process at once.
+        kwargs: Passed on to :func:`compute_surprisals`, except for
+            ``sidecar``, which is not supported.
+
+    Returns:
+        An iterator over evaluated test suites, each containing a consecutive
+        chunk of at most ``chunk_size`` items from ``suite``
+
+    Raises:
+        ValueError: If ``sidecar`` is given, since each chunk would overwrite
+            the previous chunk's sidecar file.
+    """
+    if kwargs.get("sidecar") is not None:
+        raise ValueError("Sidecar output is not supported with chunking")
 
-    # Track tokens
-    tokens = tokenize(model, suite_sentences)
+    suite = _load_suite(suite)
+    return (compute_surprisals(model, chunk, **kwargs)
+            for chunk in suite.iter_chunks(chunk_size))
 
-    # Now aggregate over regions and get result df
-    result = aggregate_surprisals(model, surprisals_df, tokens, suite)
 
-    return result
+def reaggregate(suite, sidecar: Union[str, Path, Sidecar],
+                alignment_workers: int = 1) -> Suite:
+    """
+    Recompute per-region surprisals for a suite from token-level model
+    outputs saved by :func:`compute_surprisals`, without running the model.
+    The suite's metrics or region boundaries may differ from those it was
+    originally evaluated with, as long as its sentences are unchanged.
+
+    Args:
+        suite: A path or open file stream to a suite JSON file, an already
+            loaded suite dict, or a :class:`~syntaxgym.suite.Suite`.
+        sidecar: A :class:`~syntaxgym.sidecar.Sidecar`, or the path of a
+            sidecar file.
+        alignment_workers: Maximum number of processes used to align tokens
+            with changed regions. See
+            :func:`~syntaxgym.agg_surprisals.prepare_sentences`.
+
+    Returns:
+        An evaluated test suite
+    """
+    suite = _load_suite(suite)
+    if not isinstance(sidecar, Sidecar):
+        sidecar = Sidecar.load(sidecar)
+    return reaggregate_surprisals(suite, sidecar, max_workers=alignment_workers)
 
 
 def evaluate(suite, return_df=True):
@@ -73,3 +298,183 @@ def evaluate(suite, return_df=True):
                     for pred, result in preds.items()]
     return pd.DataFrame(results_data, columns=["suite", "prediction_id", "item_number", "result"]) \
             .set_index(["suite", "prediction_id", "item_number"])
+
+
+async def compute_surprisals_async(model: Model, suite,
+                                   executor: Optional[Executor] = None,
+                                   io_executor: Optional[Executor] = None,
+                                   **kwargs) -> Suite:
+    """
+    Coroutine version of :func:`compute_surprisals` which doesn't block the
+    event loop.
+
+    The model run blocks a thread of ``io_executor`` until it finishes, so
+    the number of models running at once is capped by the size of that
+    executor. The event loop's default executor, used if ``io_executor`` is
+    ``None``, has ``min(32, os.cpu_count() + 4)`` threads; pass a larger
+    ``ThreadPoolExecutor`` to run more models concurrently.
+
+    The CPU-bound token alignment and aggregation run in ``executor``. Pass a
+    ``ProcessPoolExecutor`` here to keep alignment off the event loop's
+    process entirely.
+
+    Args:
+        model: An LM Zoo ``Model``.
+        suite: A path or open file stream to a suite JSON file, an already
+            loaded suite dict, or a :class:`~syntaxgym.suite.Suite`.
+        executor: Executor for CPU-bound work. Defaults to the event loop's
+            default executor.
+        io_executor: Executor for loading the suite and waiting on the model.
+            Defaults to the event loop's default executor.
+        kwargs: Options of :func:`compute_surprisals`, other than ``shards``
+            and ``executor``.
+    """
+    sidecar = kwargs.pop("sidecar", None)
+    agg_kwargs = _pop_aggregate_kwargs(kwargs)
+    agg_kwargs["sidecars"] = [sidecar]
+
+    # Imported here to keep asyncio out of ``import syntaxgym``; it is
+    # already loaded by the time a coroutine runs.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    suite = await loop.run_in_executor(io_executor, _load_suite, suite)
+    sentences = list(suite.iter_sentences())
+
+    surprisals_df, tokens = await loop.run_in_executor(
+        io_executor,
+        functools.partial(score_sentences, model, sentences, **kwargs))
+
+    results = await loop.run_in_executor(
+        executor, functools.partial(_aggregate_loaded, model, [suite],
+                                    [sentences], surprisals_df, tokens,
+                                    **agg_kwargs))
+    return results[0]
+
+
+async def evaluate_async(suite, return_df=True,
+                         executor: Optional[Executor] = None):
+    """
+    Coroutine version of :func:`evaluate`, which runs prediction evaluation
+    in ``executor`` (by default, the event loop's default executor).
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    suite = await loop.run_in_executor(None, _load_suite, suite)
+    return await loop.run_in_executor(executor, evaluate, suite, return_df)
+
+
+def run_models(models: Union[Mapping[str, Model], Iterable[Model]],
+               suites: Iterable, max_workers=4, **kwargs) -> pd.DataFrame:
+    """
+    Run several models over the given suites concurrently, and evaluate
+    prediction results for each.
+
+    Suites are loaded, and their sentences extracted, only once; these are
+    shared across all models. Model runs proceed in a thread pool, since
+    each spends most of its time waiting on a container or model backend.
+
+    Args:
+        models: LM Zoo ``Model``s to evaluate. If a mapping, its keys are used
+            to label each model's results; otherwise results are labeled by
+            the model name in each model's spec.
+        suites: A sequence of suites. Each may be a path or open file stream
+            to a suite JSON file, an already loaded suite dict, or a
+            :class:`~syntaxgym.suite.Suite`.
+        max_workers: Maximum number of models to run concurrently.
+        kwargs: Passed on to :func:`compute_surprisals_many`.
+
+    Returns:
+        A combined prediction results data frame, structured like the output
+        of :func:`evaluate` but with an additional ``model`` index level
+    """
+    labels = list(models.keys()) if isinstance(models, Mapping) else None
+    models = list(models.values()) if isinstance(models, Mapping) else list(models)
+
+    suites = [_load_suite(suite) for suite in suites]
+    suite_sentences = [list(suite.iter_sentences()) for suite in suites]
+
+    def run_model(model):
+        evaluated = _compute_surprisals_loaded(model, suites, suite_sentences,
+                                               **kwargs)
+        return evaluated[0].meta["model"] if evaluated else str(model), \
+            pd.concat([evaluate(suite) for suite in evaluated])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run_model, models))
+
+    if labels is None:
+        labels = [label for label, _ in results]
+    return pd.concat([result for _, result in results], keys=labels,
+                     names=["model"])
+
+
+def run_checkpoints(model: Model, suites: Iterable, checkpoints: Iterable[str],
+                    dedup=True, cache: Optional[SurprisalCache] = None,
+                    alignment_cache: Optional[AlignmentCache] = None,
+                    alignment_workers: int = 1) -> pd.DataFrame:
+    """
+    Evaluate a sweep of checkpoints of the same model on the given suites.
+
+    Checkpoints share a tokenizer, so sentences are tokenized and tokens are
+    aligned with suite regions only once. Each checkpoint then only needs to
+    compute surprisals and aggregate them over regions.
+
+    Args:
+        model: An LM Zoo ``Model``.
+        suites: A sequence of suites. Each may be a path or open file stream
+            to a suite JSON file, an already loaded suite dict, or a
+            :class:`~syntaxgym.suite.Suite`.
+        checkpoints: Host paths of model checkpoints.
+        dedup: If ``True``, score each unique sentence only once.
+        cache: An optional persistent
+            :class:`~syntaxgym.cache.SurprisalCache`.
+        alignment_cache: An optional persistent
+            :class:`~syntaxgym.cache.AlignmentCache` of token-to-region
+            alignments.
+        alignment_workers: Maximum number of processes used to align tokens
+            with regions. See :func:`~syntaxgym.agg_surprisals.prepare_sentences`.
+
+    Returns:
+        A combined prediction results data frame, structured like the output
+        of :func:`evaluate` but with an additional ``checkpoint`` index level
+    """
+    checkpoints = list(checkpoints)
+    if not checkpoints:
+        raise ValueError("No checkpoints provided")
+
+    suites = [_load_suite(suite) for suite in suites]
+    suite_sentences = [list(suite.iter_sentences()) for suite in suites]
+    all_sentences = list(itertools.chain.from_iterable(suite_sentences))
+
+    # Tokenize and align once, using the first checkpoint.
+    tokens = tokenize(model.with_checkpoint(checkpoints[0]), all_sentences)
+    suite_slices = []
+    start = 0
+    for suite, sentences in zip(suites, suite_sentences):
+        suite_slices.append((start, len(sentences)))
+        start += len(sentences)
+    suite_mappings = [
+        compute_sentence_mappings(model, tokens[start:start + n], suite,
+                                  cache=alignment_cache,
+                                  max_workers=alignment_workers)
+        for suite, (start, n) in zip(suites, suite_slices)]
+
+    results = []
+    for checkpoint in checkpoints:
+        checkpoint_model = model.with_checkpoint(checkpoint)
+        # Tokens read off the surprisal output are checked against the shared
+        # tokenization during aggregation.
+        surprisals_df, _ = score_sentences(checkpoint_model, all_sentences,
+                                           dedup=dedup, cache=cache,
+                                           single_pass=True)
+
+        checkpoint_results = []
+        for suite, (start, n), mappings in zip(suites, suite_slices, suite_mappings):
+            evaluated = aggregate_surprisals(
+                checkpoint_model, slice_surprisals(surprisals_df, start, n),
+                tokens[start:start + n], suite, sentence_mappings=mappings)
+            checkpoint_results.append(evaluate(evaluated))
+
+        results.append(pd.concat(checkpoint_results))
+
+    return pd.concat(results, keys=checkpoints, names=["checkpoint"])
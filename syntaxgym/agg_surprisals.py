@@ -4,11 +4,16 @@ raw token-level surprisal outputs from models into suites with computed
 region-level surprisals.
 """
 
-from copy import deepcopy
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import itertools
 import logging
+from pathlib import Path
 import re
 import sys
-from typing import List, Tuple, NamedTuple, Mapping
+from typing import FrozenSet, List, Tuple, NamedTuple, Mapping, Optional, \
+    Pattern, Union
 import warnings
 
 import numpy as np
@@ -18,7 +23,10 @@ from lm_zoo import spec
 from lm_zoo.models import Model, HuggingFaceModel
 
 from syntaxgym import utils
-from syntaxgym.suite import Suite, Region
+from syntaxgym.cache import AlignmentCache, suite_fingerprint, tokenizer_cache_key
+from syntaxgym.scoring import flatten_surprisals
+from syntaxgym.sidecar import Sidecar
+from syntaxgym.suite import EvaluatedSuite, RegionMetrics, Suite, Region
 
 L = logging.getLogger(__name__)
 
@@ -33,6 +41,12 @@ def _prepare_metrics(suite: Suite) -> List[str]:
         metrics = [metrics] if type(metrics) == str else metrics
     utils.validate_metrics(metrics)
 
+    # Predictions may declare metrics of their own.
+    metrics = list(metrics)
+    for prediction in suite.predictions:
+        if prediction.metric not in metrics:
+            metrics.append(prediction.metric)
+
     return metrics
 
 
@@ -60,43 +74,114 @@ class ItemSentenceMapping(NamedTuple):
     region content which were marked as out-of-vocabulary by the model.
     """
 
+    def to_json(self) -> list:
+        """
+        Convert to a JSON-serializable representation.
+        """
+        # NB, JSON object keys must be strings, so store region dicts as pairs.
+        return [list(self.id), list(self.region_to_tokens.items()),
+                list(self.oovs.items())]
+
+    @classmethod
+    def from_json(cls, data: list) -> "ItemSentenceMapping":
+        """
+        Load from the representation produced by :meth:`to_json`.
+        """
+        (item_number, condition_name), region_to_tokens, oovs = data
+        return cls(id=(item_number, condition_name),
+                   region_to_tokens=dict(region_to_tokens),
+                   oovs=dict(oovs))
+
+
+PARALLEL_ALIGNMENT_THRESHOLD = 5000
+"""
+Minimum number of sentences for which :func:`prepare_sentences` aligns
+sentences in a process pool, when more than one worker is requested. Below
+this, pool startup and pickling costs outweigh the gains.
+
+NB, serial alignment is fast (roughly 0.3s for 6000 sentences), and the
+parent process spends a large fraction of that pickling jobs and results, so
+the pool is opt-in and its speedup is bounded well below the worker count.
+"""
+
+
+def _align_sentences(profile: "TokenizerProfile", jobs: List[tuple]
+                     ) -> List[ItemSentenceMapping]:
+    """
+    Align a chunk of sentences. Each job is a tuple ``(sent_tokens,
+    item_idx, item_number, cond)``.
+    """
+    ret = []
+    for sent_tokens, i_idx, item_number, cond in jobs:
+        regions = [Region(**r) for r in cond["regions"]]
+
+        try:
+            mapping = compute_mapping_heuristic(
+                sent_tokens, regions, profile,
+                item_number=i_idx + 1,
+                condition_name=cond["condition_name"])
+        except Exception as e:
+            print("Tokens: ", sent_tokens, file=sys.stderr)
+            print("Region spec: ", cond["regions"], file=sys.stderr)
+
+            raise ValueError("Error occurred while processing item %i, "
+                             "condition %s. Relevant debug information "
+                             "printed to stderr."
+                             % (item_number, cond["condition_name"])) from e
+
+        ret.append(mapping)
+
+    return ret
+
 
 def prepare_sentences(model: Model, tokens: List[List[str]],
-                      suite: Suite) -> List[ItemSentenceMapping]:
+                      suite: Suite, max_workers: int = 1
+                      ) -> List[ItemSentenceMapping]:
     """
     Compute token-to-region mapping for each sentence in the suite. This is the
     default heuristic implementation.
-    """
-    sent_idx = 0
-    ret = []
 
+    Sentences are aligned independently. If ``max_workers`` is greater than 1
+    and the suite has at least :data:`PARALLEL_ALIGNMENT_THRESHOLD`
+    sentences, they are aligned in chunks on a process pool, with results
+    returned in suite order.
+
+    Args:
+        max_workers: Maximum number of alignment processes. By default,
+            sentences are aligned in this process.
+    """
     # Pre-fetch model spec for aggregation algorithm
-    model_spec = spec(model)
+    profile = TokenizerProfile.from_spec(spec(model))
+    return prepare_sentences_with_profile(profile, tokens, suite,
+                                          max_workers=max_workers)
+
 
+def prepare_sentences_with_profile(profile: "TokenizerProfile",
+                                   tokens: List[List[str]], suite: Suite,
+                                   max_workers: int = 1
+                                   ) -> List[ItemSentenceMapping]:
+    """
+    Compute token-to-region mapping for each sentence in the suite with the
+    heuristic method, given a tokenizer profile rather than a model. See
+    :func:`prepare_sentences`.
+    """
+    jobs = []
     for i_idx, item in enumerate(suite.items):
-        for c_idx, cond in enumerate(item['conditions']):
-            sent_tokens = tokens[sent_idx]
-            regions = [Region(**r) for r in cond["regions"]]
-
-            try:
-                mapping = compute_mapping_heuristic(
-                    sent_tokens, regions, model_spec,
-                    item_number=i_idx + 1,
-                    condition_name=cond["condition_name"])
-            except Exception as e:
-                print("Tokens: ", sent_tokens, file=sys.stderr)
-                print("Region spec: ", cond["regions"], file=sys.stderr)
-
-                raise ValueError("Error occurred while processing item %i, "
-                                 "condition %s. Relevant debug information "
-                                 "printed to stderr."
-                                 % (item["item_number"],
-                                    cond["condition_name"])) from e
-
-            ret.append(mapping)
-            sent_idx += 1
+        for cond in item["conditions"]:
+            jobs.append((tokens[len(jobs)], i_idx, item["item_number"], cond))
 
-    return ret
+    if max_workers <= 1 or len(jobs) < PARALLEL_ALIGNMENT_THRESHOLD:
+        return _align_sentences(profile, jobs)
+
+    # Dispatch several chunks per worker to even out load.
+    chunk_size = -(-len(jobs) // (max_workers * 4))
+    chunks = [jobs[start:start + chunk_size]
+              for start in range(0, len(jobs), chunk_size)]
+    L.info("Aligning %i sentences in %i chunks on %i processes",
+           len(jobs), len(chunks), max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(functools.partial(_align_sentences, profile), chunks)
+        return [mapping for chunk in results for mapping in chunk]
 
 
 MOSES_PUNCT_SPLIT_TOKEN = re.compile(r"^@([-,.])@$")
@@ -107,10 +192,156 @@ this when detokenizing here.
 """
 
 
+class TokenizerProfile(NamedTuple):
+    """
+    Tokenizer properties relevant to the heuristic token-to-region alignment,
+    resolved once from a model spec.
+    """
+
+    prefix_types: FrozenSet[str]
+    suffix_types: FrozenSet[str]
+    special_types: FrozenSet[str]
+    unk_types: FrozenSet[str]
+
+    cased: bool
+    drop_pattern: Optional[Pattern]
+    """
+    Compiled ``drop_token_pattern``: content words consisting only of
+    matching characters are dropped by the tokenizer.
+    """
+
+    subword: bool
+    sentinel_pattern: Optional[str]
+    sentinel_final: bool
+    """
+    If ``True``, subword sentinels are stripped from the right edge of
+    tokens; otherwise from the left edge.
+    """
+
+    metaspace: Optional[str]
+    moses: bool
+    """
+    Whether the tokenizer splits punctuation with Moses ``@-@`` sentinels.
+    """
+
+    @classmethod
+    def from_spec(cls, model_spec: dict) -> "TokenizerProfile":
+        tokenizer, vocabulary = model_spec["tokenizer"], model_spec["vocabulary"]
+        drop_pattern = tokenizer.get("drop_token_pattern")
+        subword = tokenizer["type"] == "subword"
+
+        return cls(
+            prefix_types=frozenset(vocabulary["prefix_types"]),
+            suffix_types=frozenset(vocabulary["suffix_types"]),
+            special_types=frozenset(vocabulary["special_types"]),
+            unk_types=frozenset(vocabulary["unk_types"]),
+            cased=tokenizer["cased"],
+            drop_pattern=re.compile(drop_pattern) if drop_pattern is not None else None,
+            subword=subword,
+            sentinel_pattern=tokenizer["sentinel_pattern"] if subword else None,
+            sentinel_final=subword and tokenizer["sentinel_position"] == "final",
+            metaspace=tokenizer.get("metaspace"),
+            moses="moses" in tokenizer.get("behaviors", []))
+
+    def strip_sentinel(self, token: str) -> str:
+        """
+        Strip subword sentinel characters from ``token``.
+        """
+        if self.sentinel_final:
+            return token.rstrip(self.sentinel_pattern)
+        return token.lstrip(self.sentinel_pattern)
+
+
+_PUNCT_START = re.compile(r"\W+")
+
+
+@functools.lru_cache(maxsize=4096)
+def _token_search_pattern(token: str) -> Pattern:
+    """
+    Build a pattern matching ``token`` in region content. Word-like tokens
+    (not punctuation) may only match at word boundaries in the content. This
+    protects against the edge case where a substring of an unk'ed token
+    matches succeeding content, e.g.
+
+        content: "will remand and order"
+        tokens: "will <unk> and order"
+
+    See test case "remand test".
+    """
+    if _PUNCT_START.match(token):
+        return re.compile(re.escape(token))
+    return re.compile(r"(?<!\w)" + re.escape(token))
+
+
+class _ContentIndex(object):
+    """
+    Index over the remaining content of a sequence of regions, used to
+    resolve OOV spans. Region contents are joined into a single string, so
+    that the leftmost match of a token across all regions can be found with
+    a single regex search.
+    """
+
+    # Joins region contents. Tokens never contain this character, so matches
+    # can't span regions; and as a non-word character it marks a word
+    # boundary at the start of each region.
+    SEPARATOR = "\0"
+
+    def __init__(self, segments: List[str]):
+        self.segments = segments
+        self.text = self.SEPARATOR.join(segments)
+
+        self.starts = []
+        start = 0
+        for segment in segments:
+            self.starts.append(start)
+            start += len(segment) + len(self.SEPARATOR)
+
+    def find(self, token: str, start_segment=0) -> Optional[Tuple[int, int]]:
+        """
+        Find the leftmost match of ``token`` in segments ``start_segment``
+        onwards.
+
+        Returns:
+            A tuple ``(segment_idx, char_idx)``, or ``None`` if there is no
+            match
+        """
+        if start_segment >= len(self.segments):
+            return None
+
+        pattern = _token_search_pattern(token)
+        pos = self.starts[start_segment]
+        while True:
+            match = pattern.search(self.text, pos)
+            if match is None:
+                return None
+
+            segment_idx = bisect_right(self.starts, match.start()) - 1
+            char_idx = match.start() - self.starts[segment_idx]
+            # Only empty tokens can match past the end of a segment.
+            if char_idx < len(self.segments[segment_idx]):
+                return segment_idx, char_idx
+            pos = match.start() + 1
+
+
 def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
-                              model_spec: dict,
+                              model_spec: Union[dict, TokenizerProfile],
                               item_number=None,
                               condition_name=None) -> ItemSentenceMapping:
+    """
+    Map tokens onto the regions of a single sentence using a heuristic
+    algorithm based on the model's tokenizer spec.
+
+    Args:
+        tokens: The sentence's tokens.
+        regions: The sentence's regions.
+        model_spec: A model spec dict, or a :class:`TokenizerProfile`
+            prepared from one. Pass a profile when aligning many sentences.
+    """
+    if isinstance(model_spec, TokenizerProfile):
+        profile = model_spec
+    else:
+        profile = TokenizerProfile.from_spec(model_spec)
+
     def get_next_region(r_idx):
         r = regions[r_idx]
         return r, r.content
@@ -123,12 +354,8 @@ def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
     oovs: Mapping[int, List[str]] = {region.region_number: []
                                      for region in regions}
 
-    # compile regex for dropping
-    if model_spec['tokenizer'].get('drop_token_pattern') is not None:
-        drop_pattern = re.compile(model_spec['tokenizer']['drop_token_pattern'])
-    else:
-        drop_pattern = None
-    metaspace = model_spec["tokenizer"].get("metaspace")
+    drop_pattern = profile.drop_pattern
+    metaspace = profile.metaspace
 
     # Sentinel: blindly add next N tokens to current region.
     skip_n = 0
@@ -143,18 +370,18 @@ def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
         # append and continue upon encountering start-of-sentence token
-        if token in model_spec['vocabulary']['prefix_types']:
+        if token in profile.prefix_types:
             region2tokens[r.region_number].append(token)
             t_idx += 1
             continue
 
         # exit loop upon encountering end-of-sentence token
-        elif token in model_spec['vocabulary']['suffix_types']:
+        elif token in profile.suffix_types:
             region2tokens[r.region_number].append(token)
             break
 
         # skip current token for special cases
-        elif token in model_spec['vocabulary']['special_types']:
+        elif token in profile.special_types:
             # TODO: which region should special_type associate with?
             t_idx += 1
             continue
@@ -168,7 +395,7 @@ def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
 
         # drop characters specified by regex (content up to next space)
         if (content != '' and drop_pattern
-            and re.sub(drop_pattern, '', content.split()[0]) == ''):
+            and drop_pattern.sub('', content.split()[0]) == ''):
             content = ' '.join(content.split()[1:])
 
         # if empty region, proceed to next region (keeping current token)
@@ -178,7 +405,7 @@ def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
             continue
 
         # remove casing if necessary
-        if not model_spec['tokenizer']['cased']:
+        if not profile.cased:
             content = content.lower()
 
         # Check for a token match at the left edge of the region.
@@ -189,12 +416,8 @@ def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
             step_count = len(token)
         # Subword tokenizers may have initial / final content that blocks
         # the match. Check again.
-        if not token_match and model_spec["tokenizer"]["type"] == "subword":
-            if model_spec["tokenizer"]["sentinel_position"] in ["initial", "medial"]:
-                stripped_token = token.lstrip(model_spec["tokenizer"]["sentinel_pattern"])
-            elif model_spec["tokenizer"]["sentinel_position"] == "final":
-                stripped_token = token.rstrip(model_spec["tokenizer"]["sentinel_pattern"])
-
+        if not token_match and profile.subword:
+            stripped_token = profile.strip_sentinel(token)
             token_match = content.startswith(stripped_token)
             # Soft subword match. Step forward the number of characters in
             # the matched subword, correcting for sentinel
@@ -215,8 +438,7 @@ def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
                 step_count = 0
 
         # Account for Moses sentinel if relevant.
-        if "moses" in model_spec["tokenizer"].get("behaviors", []) \
-            and MOSES_PUNCT_SPLIT_TOKEN.match(token):
+        if profile.moses and MOSES_PUNCT_SPLIT_TOKEN.match(token):
             # Match. Step forward the number of characters between the Moses
             # @ sentinel.
             token_match = True
@@ -224,7 +446,7 @@ def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
             step_count = len(stripped_token)
 
         # If we found a left-edge match, or this is an unk
-        if token_match or token in model_spec['vocabulary']['unk_types']:
+        if token_match or token in profile.unk_types:
 
             # First: consume the (soft) matched token.
             if token_match:
@@ -239,6 +461,7 @@ def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
                 # next non-OOV token
                 tokens_remaining = len(tokens) - t_idx
                 oov_str = None
+                content_index = None
                 for token_window_size in range(1, tokens_remaining+1):
                     # token_window_size is number of tokens to look ahead
                     if token_window_size == tokens_remaining:
@@ -262,64 +485,57 @@ def compute_mapping_heuristic(tokens: List[str], regions: List[Region],
                                 RuntimeWarning)
 
                         next_token = tokens[t_idx + token_window_size]
-                        next_token_is_punct = re.match(r"\W+", next_token)
 
-                        # Eat up content across regions until we come to a
-                        # token that we can match with `next_token`.
+                        # Search the remaining content of this and all
+                        # following regions for the leftmost match with
+                        # `next_token`. The index is only rebuilt if the
+                        # current region position has changed.
+                        if content_index is None or content_index_r_idx != r_idx \
+                                or content_index.segments[0] is not content:
+                            content_index = _ContentIndex(
+                                [content] + [region.content for region in regions[r_idx + 1:]])
+                            content_index_r_idx = r_idx
+
+                        base_r_idx = content_index_r_idx
+                        segments = content_index.segments
+                        eaten_start = 0
                         eaten_content = []
-                        for next_r_idx in range(r_idx, len(regions)):
+                        match = content_index.find(next_token)
+                        while match is not None:
+                            match_r_idx, i = match
+
+                            # Eat up content across regions until the match,
+                            # and break just before the matched token.
+                            eaten_content.extend(segment.strip() for segment
+                                                 in segments[eaten_start:match_r_idx])
+                            eaten_content.append(segments[match_r_idx][:i].strip())
+                            # NB, we use `oov_str` as a sentinel marking that
+                            # the match is complete
+                            oov_str = " ".join(eaten_content).strip()
+
+                            # track OOVs -- put them in the leftmost
+                            # associated region
+                            oovs[r.region_number].extend(oov_str.split(" "))
+
+                            # Blindly add all these eaten tokens from the
+                            # content to the leftmost region -- not including
+                            # the token that just matched, of course.
+                            region2tokens[r.region_number].extend(
+                                tokens[t_idx:t_idx + token_window_size])
+                            t_idx += token_window_size
+
+                            # Update the current region reference.
+                            r_idx = base_r_idx + match_r_idx
+                            r = regions[r_idx]
+                            content = segments[match_r_idx][i:]
+
                             if oov_str:
-                                # OOV resolution is complete. Break.
                                 break
 
-                            if next_r_idx == r_idx:
-                                next_r_content = content
-                            else:
-                                eaten_content.append(next_r_content.strip())
-                                _, next_r_content = get_next_region(next_r_idx)
-
-                            for i in range(len(next_r_content)):
-                                # When searching for a word-like token
-                                # (not punctuation), only allow matches at
-                                # token boundaries in region content.
-                                # This protects against the edge case where
-                                # a substring of the unk'ed token matches
-                                # a succeeding content in the token, e.g.
-                                #   content: "will remand and order"
-                                #   tokens: "will <unk> and order"
-                                #
-                                # See test case "remand test"
-                                if not next_token_is_punct and \
-                                  (i > 0 and not re.match(r"\W", next_r_content[i - 1])):
-                                    continue
-
-                                if next_r_content[i:i+len(next_token)] == next_token:
-                                    # We found a token which faithfully
-                                    # matches the reference token. Break
-                                    # just before that token.
-                                    eaten_content.append(next_r_content[:i].strip())
-                                    # NB, we use `oov_str` as a sentinel
-                                    # marking that the match is complete
-                                    oov_str = " ".join(eaten_content).strip()
-
-                                    # track OOVs -- put them in the
-                                    # leftmost associated region
-                                    oovs[r.region_number].extend(oov_str.split(" "))
-
-                                    # Blindly add all these eaten tokens
-                                    # from the content to the leftmost
-                                    # region -- not including the token
-                                    # that just matched, of course.
-                                    region2tokens[r.region_number].extend(
-                                        tokens[t_idx:t_idx + token_window_size])
-                                    t_idx += token_window_size
-
-                                    # Update the current region reference.
-                                    r_idx = next_r_idx
-                                    r = regions[r_idx]
-                                    content = next_r_content[i:]
-
-                                    break
+                            # An empty OOV string doesn't complete the match:
+                            # keep searching from the next region on.
+                            eaten_start = match_r_idx
+                            match = content_index.find(next_token, match_r_idx + 1)
 
                         if oov_str:
                             # OOV resolution is complete. Break.
@@ -367,28 +583,114 @@ def prepare_sentences_huggingface(model: Model, tokens: List[List[str]],
     region_edges = list(suite.iter_region_edges())
 
     # Hack: re-tokenize here in order to detokenize back to character-level
-    # offsets.
+    # offsets. LM Zoo's `tokenize` doesn't expose offsets, so this is one
+    # extra (batched) tokenizer pass; encode each unique sentence only once.
     sentences = list(suite.iter_sentences())
+    unique_sentences = list(dict.fromkeys(sentences))
     encoded = model.tokenizer.batch_encode_plus(
-        sentences, add_special_tokens=True, return_offsets_mapping=True)
-
-    ret: List[ItemSentenceMapping] = []
+        unique_sentences, add_special_tokens=True, return_offsets_mapping=True)
+    encoded_idxs = {sentence: idx for idx, sentence in enumerate(unique_sentences)}
+    sent_encoded_idxs = [encoded_idxs[sentence] for sentence in sentences]
 
-    sent_idx = 0
+    regions, ids = [], []
     for i_idx, item in enumerate(suite.items):
-        for c_idx, cond in enumerate(item["conditions"]):
-            regions = [Region(**r) for r in cond["regions"]]
-
-            ret.append(compute_mapping_huggingface(
-                encoded.tokens(sent_idx),
-                regions,
-                encoded["offset_mapping"][sent_idx],
-                region_edges[sent_idx],
-                item_number=i_idx + 1,
-                condition_name=cond["condition_name"]
-            ))
+        for cond in item["conditions"]:
+            regions.append([Region(**r) for r in cond["regions"]])
+            ids.append((i_idx + 1, cond["condition_name"]))
 
-            sent_idx += 1
+    return compute_mappings_huggingface(
+        [encoded.tokens(idx) for idx in sent_encoded_idxs],
+        regions,
+        [encoded["offset_mapping"][idx] for idx in sent_encoded_idxs],
+        region_edges, ids)
+
+
+def _assign_token_regions(token_offsets: List[List[Tuple[int, int]]],
+                          region_edges: List[List[int]]) -> np.ndarray:
+    """
+    Assign each token to a region, given token character offsets and region
+    left edges for many sentences.
+
+    Each token belongs to the last region whose left edge is at or before the
+    token start. Region assignments never move backwards within a sentence,
+    so a token starting inside an earlier region (e.g. a special token with
+    offset ``(0, 0)`` at the end of the sentence) stays in the current one.
+
+    All sentences are processed at once: offsets are shifted so that
+    sentences occupy disjoint character ranges, and region indices so that
+    they occupy disjoint index ranges.
+
+    Returns:
+        For each token of each sentence (concatenated), the index of its
+        region among all regions of all sentences. These indices are
+        non-decreasing.
+    """
+    lengths = np.array([len(offsets) for offsets in token_offsets], dtype=int)
+    n_regions = np.array([len(edges) for edges in region_edges], dtype=int)
+    starts = np.fromiter((start for offsets in token_offsets for start, _ in offsets),
+                         dtype=np.int64, count=lengths.sum())
+    # NB region boundaries are left edges; the first region's left edge is
+    # irrelevant.
+    n_tail_edges = np.maximum(n_regions - 1, 0)
+    tail_edges = np.fromiter(itertools.chain.from_iterable(
+                                 edges[1:] for edges in region_edges),
+                             dtype=np.int64, count=n_tail_edges.sum())
+    if len(starts) == 0:
+        return np.zeros(0, dtype=int)
+
+    # Give each sentence a disjoint character range.
+    extent = max(starts.max(), tail_edges.max() if len(tail_edges) else 0) + 1
+    char_bases = np.arange(len(token_offsets), dtype=np.int64) * extent
+    starts += np.repeat(char_bases, lengths)
+    tail_edges += np.repeat(char_bases, n_tail_edges)
+
+    region_idxs = np.searchsorted(tail_edges, starts, side="right") \
+        - np.repeat(np.cumsum(n_tail_edges) - n_tail_edges, lengths)
+
+    # Regions never move backwards within a sentence.
+    region_bases = np.repeat(np.cumsum(n_regions) - n_regions, lengths)
+    return np.maximum.accumulate(region_idxs + region_bases)
+
+
+def compute_mappings_huggingface(tokens: List[List[str]],
+                                 regions: List[List[Region]],
+                                 token_offsets: List[List[Tuple[int, int]]],
+                                 region_edges: List[List[int]],
+                                 ids: List[Tuple[int, str]]
+                                 ) -> List[ItemSentenceMapping]:
+    """
+    Compute token-to-region mappings for many sentences at once from
+    Huggingface tokenizer character offsets. See
+    :func:`compute_mapping_huggingface` for arguments; each argument here is
+    a list with one element per sentence. ``ids`` gives the item number and
+    condition name for each sentence.
+    """
+    token_regions = _assign_token_regions(token_offsets, region_edges)
+
+    # Tokens of each region are contiguous: find the token span of every
+    # region of every sentence.
+    n_regions = [len(edges) for edges in region_edges]
+    region_ends = np.cumsum(np.bincount(token_regions, minlength=sum(n_regions))).tolist()
+
+    ret = []
+    region_idx, token_offset = 0, 0
+    for sent_tokens, sent_regions, (item_number, condition_name) \
+            in zip(tokens, regions, ids):
+        region2tokens = {r.region_number: [] for r in sent_regions}
+
+        start = 0
+        for r_idx in range(len(sent_regions)):
+            end = region_ends[region_idx] - token_offset
+            if end > start:
+                region2tokens[r_idx + 1].extend(sent_tokens[start:end])
+                start = end
+            region_idx += 1
+        token_offset += len(sent_tokens)
+
+        ret.append(ItemSentenceMapping(
+            id=(item_number, condition_name),
+            region_to_tokens=region2tokens,
+            oovs={region: [] for region in region2tokens.keys()}))
 
     return ret
 
@@ -398,93 +700,281 @@ def compute_mapping_huggingface(tokens: List[str], regions: List[Region],
                                 region_edges: List[int],
                                 item_number=None,
                                 condition_name=None) -> ItemSentenceMapping:
-    region2tokens = {r.region_number: [] for r in regions}
-    r_cursor, t_cursor = 0, 0
-    while t_cursor < len(tokens):
-        token = tokens[t_cursor]
-        token_char_start, token_char_end = token_offsets[t_cursor]
-
-        region_start = region_edges[r_cursor]
-        region_end = region_edges[r_cursor + 1] \
-            if r_cursor + 1 < len(region_edges) else np.inf
-
-        # NB region boundaries are left edges, hence the >= here.
-        if token_char_start >= region_end:
-            r_cursor += 1
-            continue
+    """
+    Compute a token-to-region mapping for a single sentence from Huggingface
+    tokenizer character offsets.
+
+    Args:
+        tokens: The sentence's tokens.
+        regions: The sentence's regions.
+        token_offsets: Character ``(start, end)`` offsets of each token in
+            the sentence.
+        region_edges: Character offset of each region's left edge, as
+            computed by :meth:`~syntaxgym.suite.Suite.iter_region_edges`.
+    """
+    return compute_mappings_huggingface(
+        [tokens], [regions], [token_offsets], [region_edges],
+        [(item_number, condition_name)])[0]
 
-        region2tokens[r_cursor + 1].append(token)
-        t_cursor += 1
 
-    return ItemSentenceMapping(
-        id=(item_number, condition_name),
-        region_to_tokens=region2tokens,
-        oovs={region: []
-              for region in region2tokens.keys()})
+def compute_sentence_mappings(model: Model, tokens: List[List[str]],
+                              suite: Suite,
+                              cache: Optional[AlignmentCache] = None,
+                              max_workers: int = 1
+                              ) -> List[ItemSentenceMapping]:
+    """
+    Compute token-to-region mapping for each sentence in the suite, using the
+    most reliable method available for the given model.
+
+    Args:
+        model: An LM Zoo ``Model``.
+        tokens: ``tokenize`` output for the suite's sentences.
+        suite: Suite to align.
+        cache: An optional persistent
+            :class:`~syntaxgym.cache.AlignmentCache`. Alignments depend only
+            on the tokenizer and the suite, so models which share a tokenizer
+            can reuse each other's alignments.
+        max_workers: Maximum number of processes used by the heuristic
+            alignment method. See :func:`prepare_sentences`.
+    """
+    if isinstance(model, HuggingFaceModel) and model.provides_token_offsets:
+        method, mapper = "huggingface", prepare_sentences_huggingface
+    else:
+        method = "heuristic"
+        mapper = functools.partial(prepare_sentences, max_workers=max_workers)
 
+    if cache is None:
+        return mapper(model, tokens, suite)
 
-def aggregate_surprisals(model: Model, surprisals: pd.DataFrame,
-                         tokens: List[List[str]], suite: Suite):
-    metrics = _prepare_metrics(suite)
+    key = "%s:%s:%s" % (method, tokenizer_cache_key(spec(model)),
+                        suite_fingerprint(suite))
+    cached = cache.get(key, tokens)
+    if cached is not None:
+        L.info("Using cached token-to-region alignments")
+        return [ItemSentenceMapping.from_json(mapping) for mapping in cached]
 
-    ret = deepcopy(suite)
-    surprisals = surprisals.reset_index().set_index("sentence_id")
+    mappings = mapper(model, tokens, suite)
+    cache.put(key, tokens, [mapping.to_json() for mapping in mappings])
+    return mappings
 
-    # Checks
-    sent_idx = 0
-    for i_idx, item in enumerate(suite.items):
-        for c_idx, cond in enumerate(item['conditions']):
-            # fetch sentence data
-            sent_tokens = tokens[sent_idx]
-            sent_surps = surprisals.loc[sent_idx + 1]
 
-            if sent_tokens != list(sent_surps.token):
-                raise ValueError("Mismatched tokens between tokens and surprisals data frame")
+def find_token_mismatches(tokens: List[List[str]], surp_tokens: np.ndarray,
+                          offsets: np.ndarray) -> np.ndarray:
+    """
+    Compare ``tokenize`` output with the tokens of a flattened surprisal data
+    frame, checking all sentences at once.
+
+    Args:
+        tokens: ``tokenize`` output.
+        surp_tokens: Flat array of surprisal data frame tokens.
+        offsets: Sentence offsets into ``surp_tokens``, as returned by
+            :func:`~syntaxgym.scoring.flatten_surprisals`.
+
+    Returns:
+        Sorted indices of sentences whose tokens don't match
+    """
+    lengths = np.array([len(sent_tokens) for sent_tokens in tokens], dtype=int)
+    surp_lengths = np.diff(offsets)
+    same_length = lengths == surp_lengths
+
+    flat_tokens = list(itertools.chain.from_iterable(tokens))
+    surp_tokens = surp_tokens[offsets[0]:offsets[-1]]
+    # Fast path: a single comparison over all tokens.
+    if same_length.all() and flat_tokens == surp_tokens.tolist():
+        return np.array([], dtype=int)
+
+    # Otherwise compare position by position for sentences of equal length,
+    # to find every mismatching sentence.
+    flat_tokens_arr = np.empty(len(flat_tokens), dtype=object)
+    flat_tokens_arr[:] = flat_tokens
+    surp_tokens = np.asarray(surp_tokens, dtype=object)
+
+    check_lengths = lengths[same_length]
+    within = np.arange(check_lengths.sum()) \
+        - np.repeat(np.cumsum(check_lengths) - check_lengths, check_lengths)
+    token_starts = np.cumsum(lengths) - lengths
+    unequal = flat_tokens_arr[np.repeat(token_starts[same_length], check_lengths) + within] \
+        != surp_tokens[np.repeat(offsets[:-1][same_length] - offsets[0], check_lengths) + within]
+
+    mismatched = ~same_length
+    mismatched[np.repeat(np.flatnonzero(same_length), check_lengths)[unequal]] = True
+    return np.flatnonzero(mismatched)
+
+
+def _check_mapped_tokens(mapped_tokens: List[str], sent_tokens: List[str]):
+    """
+    Check that the tokens mapped onto a sentence's regions match the prefix
+    of the sentence's tokens, raising :class:`~syntaxgym.utils.TokenMismatch`
+    at the first mismatch.
+    """
+    if mapped_tokens == sent_tokens[:len(mapped_tokens)]:
+        return
+
+    for t_idx, token in enumerate(mapped_tokens):
+        sent_token = sent_tokens[t_idx] if t_idx < len(sent_tokens) else None
+        if token != sent_token:
+            raise utils.TokenMismatch(token, sent_token, t_idx + 2)
+
+
+def aggregate_surprisals(model: Model, surprisals: pd.DataFrame,
+                         tokens: List[List[str]], suite: Suite,
+                         sentence_mappings: Optional[List[ItemSentenceMapping]] = None,
+                         alignment_cache: Optional[AlignmentCache] = None,
+                         sidecar: Optional[Union[str, Path]] = None,
+                         alignment_workers: int = 1):
+    """
+    Aggregate token-level surprisals into region-level surprisals for each
+    sentence in the suite.
+
+    Args:
+        model: An LM Zoo ``Model``.
+        surprisals: ``get_surprisals`` output for the suite's sentences.
+        tokens: ``tokenize`` output for the suite's sentences.
+        suite: Suite to evaluate.
+        sentence_mappings: Precomputed token-to-region mappings, as returned
+            by :func:`compute_sentence_mappings`. Computed from ``tokens`` if
+            not provided.
+        alignment_cache: An optional persistent
+            :class:`~syntaxgym.cache.AlignmentCache` used when computing
+            ``sentence_mappings``.
+        sidecar: If not ``None``, write token-level outputs and region
+            segments to a :class:`~syntaxgym.sidecar.Sidecar` file at this
+            path, from which metrics can later be recomputed with
+            :func:`reaggregate_surprisals`.
+        alignment_workers: Maximum number of processes used to compute
+            ``sentence_mappings``. See :func:`prepare_sentences`.
+
+    Returns:
+        An :class:`~syntaxgym.suite.EvaluatedSuite`, which shares structure
+        with ``suite``
+    """
+    # Convert surprisals to flat arrays once; each sentence's outputs are then
+    # array slices.
+    surp_tokens, surp_values, offsets = flatten_surprisals(surprisals, len(tokens))
+
+    # Checks
+    mismatches = find_token_mismatches(tokens, surp_tokens, offsets)
+    if len(mismatches) > 0:
+        sentence_ids = [(item["item_number"], cond["condition_name"])
+                        for item in suite.items for cond in item["conditions"]]
+        raise ValueError(
+            "Mismatched tokens between tokens and surprisals data frame in %i "
+            "sentence(s): %s" % (len(mismatches), ", ".join(
+                "item %s, condition %s" % sentence_ids[sent_idx]
+                if sent_idx < len(sentence_ids) else "sentence %i" % (sent_idx + 1)
+                for sent_idx in mismatches)))
 
     # Run sentence prep procedure -- map tokens in each sentence onto regions
     # of corresponding test trial sentence
-    if isinstance(model, HuggingFaceModel) and model.provides_token_offsets:
-        mapper = prepare_sentences_huggingface
-    else:
-        mapper = prepare_sentences
+    if sentence_mappings is None:
+        sentence_mappings = compute_sentence_mappings(
+            model, tokens, suite, cache=alignment_cache,
+            max_workers=alignment_workers)
+
+    return _aggregate_flat(spec(model), tokens, surp_values, offsets, suite,
+                           sentence_mappings, sidecar=sidecar)
+
 
-    sentence_mappings: List[ItemSentenceMapping] = mapper(model, tokens, suite)
+def _evaluated_suite(model_spec: dict, suite: Suite, region_values: RegionMetrics,
+                     region_oovs: List[List[str]]) -> EvaluatedSuite:
+    # Share structure with the original suite rather than copying it.
+    meta = dict(suite.meta)
+    meta["model"] = model_spec["name"]
+    return EvaluatedSuite.from_suite(suite, region_values, region_oovs, meta=meta)
 
-    # Bring in surprisals
+
+def _aggregate_flat(model_spec: dict, tokens: List[List[str]],
+                    surp_values: np.ndarray, offsets: np.ndarray, suite: Suite,
+                    sentence_mappings: List[ItemSentenceMapping],
+                    sidecar: Optional[Union[str, Path]] = None
+                    ) -> EvaluatedSuite:
+    """
+    Aggregate flat token-level surprisals, as returned by
+    :func:`~syntaxgym.scoring.flatten_surprisals`, given token-to-region
+    mappings for each sentence of the suite.
+    """
+    metrics = _prepare_metrics(suite)
+
+    # Bring in surprisals. Collect the surprisals of each region's tokens into
+    # one flat array, so that region metrics can be computed in bulk.
+    region_surprisals = []
+    region_starts = []
+    region_lengths = []
+    region_oovs = []
     sent_idx = 0
-    for i_idx, item in enumerate(suite.items):
-        for c_idx, cond in enumerate(item["conditions"]):
+    for item in suite.items:
+        for cond in item["conditions"]:
             sent_mapping = sentence_mappings[sent_idx]
 
             sent_tokens = tokens[sent_idx]
-            sent_surps = surprisals.loc[sent_idx + 1].surprisal.values
-
-            # iterate through regions in sentence
-            t_idx = 0
-            for r_idx, (region_number, region_tokens) in enumerate(sent_mapping.region_to_tokens.items()):
-                region_surprisals = []
-                for token in region_tokens:
-                    # append to region surprisals if exact token match
-                    if token == sent_tokens[t_idx]:
-                        region_surprisals.append(sent_surps[t_idx])
-                        t_idx += 1
-                    else:
-                        raise utils.TokenMismatch(token, sent_tokens[t_idx], t_idx+2)
+            sent_surps = surp_values[offsets[sent_idx]:offsets[sent_idx + 1]]
+
+            # regions consume the sentence's tokens in order
+            mapped_tokens = [token for region_tokens in sent_mapping.region_to_tokens.values()
+                             for token in region_tokens]
+            _check_mapped_tokens(mapped_tokens, sent_tokens)
+
+            region_surprisals.append(sent_surps[:len(mapped_tokens)])
+            start = offsets[sent_idx]
+            for region_tokens in sent_mapping.region_to_tokens.values():
+                region_starts.append(start)
+                region_lengths.append(len(region_tokens))
+                start += len(region_tokens)
+            region_oovs.extend(sent_mapping.oovs[region_number]
+                               for region_number in sent_mapping.region_to_tokens)
 
-                # get dictionary of region-level surprisal values for each metric
-                vals = {m: utils.METRICS[m](region_surprisals)
-                        for m in metrics}
+            # update sentence counter
+            sent_idx += 1
 
-                # insert surprisal values into original dict
-                ret.items[i_idx]['conditions'][c_idx]['regions'][r_idx]['metric_value'] = vals
+    # Metric values are computed from these on first access.
+    region_values = RegionMetrics(
+        metrics, np.concatenate(region_surprisals) if region_surprisals else [],
+        region_lengths)
 
-                # update original dict with OOV information
-                ret.items[i_idx]['conditions'][c_idx]['regions'][r_idx]['oovs'] = \
-                  sent_mapping.oovs[region_number]
+    if sidecar is not None:
+        Sidecar(spec=model_spec,
+                sentences=list(suite.iter_sentences()),
+                tokens=[token for sent_tokens in tokens for token in sent_tokens],
+                surprisals=surp_values,
+                offsets=offsets,
+                suite_fingerprint=suite_fingerprint(suite),
+                region_starts=np.array(region_starts, dtype=int),
+                region_lengths=region_values.region_lengths,
+                region_oovs=region_oovs).save(sidecar)
 
-            # update sentence counter
-            sent_idx += 1
+    return _evaluated_suite(model_spec, suite, region_values, region_oovs)
 
-    # update meta information with model name
-    ret.meta['model'] = spec(model)['name']
-    return ret
+
+def reaggregate_surprisals(suite: Suite, sidecar: Sidecar,
+                           max_workers: int = 1) -> EvaluatedSuite:
+    """
+    Recompute region-level metrics for ``suite`` from token-level outputs
+    stored in a sidecar, without running the model.
+
+    If the suite is the one the sidecar was written for, the stored region
+    segments are reused. Otherwise (e.g. if region boundaries have changed),
+    the stored tokens of each sentence are re-aligned with the suite's
+    regions using the heuristic method; every sentence of the suite must
+    then have stored outputs.
+
+    Args:
+        suite: Suite to evaluate.
+        sidecar: Stored outputs, as written by :func:`aggregate_surprisals`.
+        max_workers: Maximum number of alignment processes. See
+            :func:`prepare_sentences`.
+    """
+    if suite_fingerprint(suite) == sidecar.suite_fingerprint:
+        region_values = RegionMetrics(_prepare_metrics(suite),
+                                      sidecar.region_surprisals(),
+                                      sidecar.region_lengths)
+        return _evaluated_suite(sidecar.spec, suite, region_values,
+                                sidecar.region_oovs)
+
+    L.info("Suite differs from sidecar; re-aligning stored tokens")
+    tokens, surp_values, offsets = \
+        sidecar.select_sentences(list(suite.iter_sentences()))
+    sentence_mappings = prepare_sentences_with_profile(
+        TokenizerProfile.from_spec(sidecar.spec), tokens, suite,
+        max_workers=max_workers)
+    return _aggregate_flat(sidecar.spec, tokens, surp_values, offsets, suite,
+                           sentence_mappings)
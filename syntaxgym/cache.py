@@ -0,0 +1,401 @@
+"""
+Defines a persistent on-disk cache of token-level model outputs, so that
+sentences which have already been scored by a model need not be sent to the
+model again.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, List, NamedTuple, Optional, Union
+
+import numpy as np
+
+from lm_zoo import spec
+from lm_zoo.models import Model, HuggingFaceModel
+
+from syntaxgym import utils
+from syntaxgym.suite import Suite
+
+L = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME",
+                                        Path.home() / ".cache")) / "syntaxgym"
+"""
+Default directory for persistent syntaxgym caches.
+"""
+
+DEFAULT_MAX_SIZE = 2 ** 30
+"""
+Default maximum size of the surprisal cache, in bytes. Least recently used
+entries are evicted once the cache grows past this size.
+"""
+
+# Maximum number of bound parameters in a single SQLite query.
+_QUERY_BATCH_SIZE = 500
+
+# Seconds to wait for another process's write to a cache database to finish,
+# e.g. when surprisal shards run in parallel.
+_BUSY_TIMEOUT = 60.0
+
+# Read size used when computing file content digests.
+_DIGEST_CHUNK_SIZE = 2 ** 20
+
+
+class CachedSentence(NamedTuple):
+    """
+    Model outputs for a single sentence.
+    """
+
+    tokens: List[str]
+    """
+    Tokenized sentence, as output by ``tokenize``
+    """
+
+    surprisal_tokens: List[str]
+    """
+    Tokens listed in the ``get_surprisals`` output. These should match
+    ``tokens``, but we keep them separately so that mismatches are still
+    detected downstream.
+    """
+
+    surprisals: np.ndarray
+    """
+    Token-level surprisals, as output by ``get_surprisals``
+    """
+
+
+@functools.lru_cache(maxsize=None)
+def _file_digest(path: str, stat_key: tuple) -> str:
+    """
+    Compute a SHA-256 digest of a file's contents. Memoized on the file's
+    inode, size and modification and change times, so that each file is read
+    at most once per process unless it changes.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_DIGEST_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _hash_path(path: Union[str, Path]) -> str:
+    """
+    Compute a fingerprint of a file or directory, combining its resolved
+    absolute path with the names and content digests of the files it
+    contains.
+
+    Raises:
+        ValueError: If ``path`` does not exist.
+    """
+    path = Path(path).resolve()
+    if not path.exists():
+        raise ValueError("Cannot fingerprint missing path %s" % path)
+    paths = sorted(path.rglob("*")) if path.is_dir() else [path]
+
+    h = hashlib.sha256()
+    h.update(("%s\0" % path).encode("utf-8"))
+    for p in paths:
+        if p.is_file():
+            stat = p.stat()
+            stat_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                        stat.st_ctime_ns)
+            h.update(("%s\0%s\0" % (p.relative_to(path.parent),
+                                     _file_digest(str(p), stat_key))).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _model_identity(model: Model) -> dict:
+    """
+    Describe the identity of a model's weights: a docker image digest, a
+    content fingerprint of a dummy model's reference data or of any custom
+    checkpoint, and for Huggingface models, the hub commit hash or a
+    fingerprint of a local model directory.
+
+    Raises:
+        ValueError: If the model's weights can't be identified by content,
+            e.g. because its image hasn't been pulled, it is a Singularity
+            model without a custom checkpoint, or its checkpoint path is
+            missing.
+    """
+    if isinstance(model, HuggingFaceModel):
+        identity = {"model": "huggingface://%s" % (model.model_ref,)}
+        if Path(model.model_ref).is_dir():
+            identity["model_dir"] = _hash_path(model.model_ref)
+        else:
+            commit_hash = getattr(getattr(model, "_config", None),
+                                  "_commit_hash", None)
+            if commit_hash is None:
+                raise ValueError("Could not determine the hub revision of "
+                                 "Huggingface model %s" % (model.model_ref,))
+            identity["commit_hash"] = commit_hash
+    else:
+        identity = {"model": str(model)}
+
+    if model.checkpoint is not None:
+        identity["checkpoint"] = _hash_path(model.checkpoint)
+
+    if "dummy" in model.platforms:
+        identity["reference"] = _hash_path(model.reference)
+    elif "docker" in model.platforms:
+        try:
+            image = utils._get_docker_client().images.get(
+                "%s:%s" % (model.image, model.tag))
+            identity["image_id"] = image.id
+        except Exception as e:
+            # A checkpoint fingerprint still identifies the weights.
+            if model.checkpoint is None:
+                raise ValueError("Could not retrieve image digest for model "
+                                 "%s: %s" % (model, e)) from e
+    elif len(identity) == 1:
+        raise ValueError("Cannot identify the weights of model %s, which has "
+                         "no image digest or custom checkpoint" % (model,))
+
+    return identity
+
+
+def model_cache_key(model: Model) -> str:
+    """
+    Compute a key identifying the outputs of ``model``, combining the model's
+    image digest or checkpoint fingerprint with its tokenizer specification.
+
+    Raises:
+        ValueError: If the model's weights can't be identified. See
+            :func:`_model_identity`.
+    """
+    key = {"identity": _model_identity(model), "spec": spec(model)}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")) \
+        .hexdigest()
+
+
+class _SQLiteCache(object):
+    """
+    Base class for persistent SQLite-backed caches. Each subclass stores its
+    entries in a single table with ``size`` and ``last_access`` columns,
+    which are used to evict least recently used entries once the cache grows
+    beyond ``max_size`` bytes.
+
+    A cache file may be shared by several processes. Writers wait up to
+    ``_BUSY_TIMEOUT`` seconds for each other's transactions to finish.
+    """
+
+    table: str
+    schema: str
+    default_filename: str
+
+    def __init__(self, path: Optional[Union[str, Path]] = None,
+                 max_size: int = DEFAULT_MAX_SIZE):
+        """
+        Args:
+            path: Path to the SQLite cache database. Defaults to a file in
+                :data:`DEFAULT_CACHE_DIR`.
+            max_size: Maximum total size of cached entries, in bytes.
+        """
+        self.path = Path(path) if path is not None \
+            else DEFAULT_CACHE_DIR / self.default_filename
+        self.max_size = max_size
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=_BUSY_TIMEOUT,
+                                     check_same_thread=False)
+        # Let readers proceed while another process writes.
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS %s (%s)"
+                               % (self.table, self.schema))
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS %s_last_access ON %s (last_access)"
+                % (self.table, self.table))
+
+    def _evict(self):
+        total_size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM %s" % self.table).fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        evict_rowids = []
+        to_free = total_size - self.max_size
+        for rowid, size in self._conn.execute(
+                "SELECT rowid, size FROM %s ORDER BY last_access" % self.table):
+            if to_free <= 0:
+                break
+            evict_rowids.append((rowid,))
+            to_free -= size
+
+        L.info("Evicting %i entries from %s cache", len(evict_rowids), self.table)
+        self._conn.executemany("DELETE FROM %s WHERE rowid = ?" % self.table,
+                               evict_rowids)
+
+    def __getstate__(self):
+        # Connections can't be shared across processes. Reconnect on unpickle.
+        return {"path": self.path, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+class SurprisalCache(_SQLiteCache):
+    """
+    A persistent cache of per-sentence tokenizations and surprisals, keyed by
+    model identity and sentence text. Least recently used entries are evicted
+    when the cache grows beyond ``max_size`` bytes.
+    """
+
+    table = "surprisals"
+    schema = ("model TEXT, sentence TEXT, tokens TEXT, surprisal_tokens TEXT,"
+              " surprisals BLOB, size INTEGER, last_access REAL,"
+              " PRIMARY KEY (model, sentence)")
+    default_filename = "surprisals.sqlite"
+
+    def get_many(self, model_key: str, sentences: Iterable[str]
+                 ) -> Dict[str, CachedSentence]:
+        """
+        Look up cached outputs for the given sentences. Sentences missing from
+        the cache are omitted from the returned dict.
+        """
+        sentences = list(sentences)
+        ret = {}
+        with self._lock, self._conn:
+            for i in range(0, len(sentences), _QUERY_BATCH_SIZE):
+                batch = sentences[i:i + _QUERY_BATCH_SIZE]
+                rows = self._conn.execute(
+                    "SELECT sentence, tokens, surprisal_tokens, surprisals "
+                    "FROM surprisals WHERE model = ? AND sentence IN (%s)"
+                    % ",".join("?" * len(batch)),
+                    [model_key] + batch)
+
+                for sentence, tokens, surprisal_tokens, surprisals in rows:
+                    tokens = json.loads(tokens)
+                    surprisal_tokens = json.loads(surprisal_tokens) \
+                        if surprisal_tokens is not None else tokens
+                    ret[sentence] = CachedSentence(
+                        tokens, surprisal_tokens,
+                        np.frombuffer(surprisals, dtype=np.float64))
+
+            # Mark hits as recently used.
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE surprisals SET last_access = ? "
+                "WHERE model = ? AND sentence = ?",
+                [(now, model_key, sentence) for sentence in ret])
+
+        return ret
+
+    def put_many(self, model_key: str, entries: Dict[str, CachedSentence]):
+        """
+        Store model outputs for the given sentences, then evict least recently
+        used entries if the cache has grown too large.
+        """
+        now = time.time()
+        rows = []
+        for sentence, entry in entries.items():
+            tokens = json.dumps(entry.tokens)
+            surprisal_tokens = json.dumps(entry.surprisal_tokens) \
+                if list(entry.surprisal_tokens) != list(entry.tokens) else None
+            surprisals = np.asarray(entry.surprisals, dtype=np.float64).tobytes()
+
+            size = len(sentence) + len(tokens) + len(surprisals) \
+                + len(surprisal_tokens or "")
+            rows.append((model_key, sentence, tokens, surprisal_tokens,
+                         surprisals, size, now))
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO surprisals VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows)
+            self._evict()
+
+
+def tokenizer_cache_key(model_spec: dict) -> str:
+    """
+    Compute a key identifying a model's tokenizer, based on the tokenizer and
+    vocabulary sections of its spec. Models which share a tokenizer (e.g.
+    different sizes of GPT-2) share a key.
+    """
+    key = {k: model_spec[k] for k in ("tokenizer", "vocabulary")}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")) \
+        .hexdigest()
+
+
+def suite_fingerprint(suite: Suite) -> str:
+    """
+    Compute a fingerprint of a suite's items, conditions and region contents.
+    """
+    h = hashlib.sha256()
+    for item in suite.items:
+        for cond in item["conditions"]:
+            h.update(json.dumps([item["item_number"], cond["condition_name"],
+                                 [(region["region_number"], region["content"])
+                                  for region in cond["regions"]]]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def tokens_fingerprint(tokens: List[List[str]]) -> str:
+    """
+    Compute a fingerprint of a tokenized list of sentences.
+    """
+    h = hashlib.sha256()
+    for sent_tokens in tokens:
+        h.update(json.dumps(sent_tokens).encode("utf-8"))
+    return h.hexdigest()
+
+
+class AlignmentCache(_SQLiteCache):
+    """
+    A persistent cache of token-to-region alignments, keyed by tokenizer,
+    alignment method and suite. Alignments are stored as compressed JSON.
+
+    Each entry also records a fingerprint of the tokens it was computed from,
+    and is only reused when the tokens match.
+    """
+
+    table = "alignments"
+    schema = ("key TEXT PRIMARY KEY, tokens TEXT, mappings BLOB,"
+              " size INTEGER, last_access REAL")
+    default_filename = "alignments.sqlite"
+
+    def get(self, key: str, tokens: List[List[str]]) -> Optional[list]:
+        """
+        Retrieve JSON-encoded alignments for the given key, or ``None`` if no
+        alignments computed from ``tokens`` are cached.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT tokens, mappings FROM alignments WHERE key = ?",
+                (key,)).fetchone()
+            if row is None or row[0] != tokens_fingerprint(tokens):
+                return None
+
+            self._conn.execute(
+                "UPDATE alignments SET last_access = ? WHERE key = ?",
+                (time.time(), key))
+
+        return json.loads(zlib.decompress(row[1]))
+
+    def put(self, key: str, tokens: List[List[str]], mappings: list):
+        """
+        Store JSON-serializable alignments computed from ``tokens``.
+        """
+        data = zlib.compress(json.dumps(mappings).encode("utf-8"))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?, ?)",
+                (key, tokens_fingerprint(tokens), data, len(data), time.time()))
+            self._evict()
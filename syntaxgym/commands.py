@@ -1,11 +1,14 @@
 import json
 import logging
+from pathlib import Path
 import sys
 
 import click
+import pandas as pd
 
 from lm_zoo import get_registry
 import syntaxgym as S
+from syntaxgym.cache import AlignmentCache, SurprisalCache
 
 
 def _prepare_model(model_ref, checkpoint=None):
@@ -15,6 +18,25 @@ def _prepare_model(model_ref, checkpoint=None):
     return model
 
 
+def _prepare_caches(cache):
+    """
+    Build keyword arguments enabling persistent surprisal and alignment
+    caches, if requested.
+    """
+    if not cache:
+        return {}
+    return {"cache": SurprisalCache(), "alignment_cache": AlignmentCache()}
+
+
+def _list_checkpoints(checkpoint_dir):
+    """
+    List the checkpoints stored in ``checkpoint_dir``, skipping hidden
+    entries such as lock or metadata files.
+    """
+    return sorted(str(path) for path in Path(checkpoint_dir).iterdir()
+                  if not path.name.startswith("."))
+
+
 class State(object):
     def __init__(self):
         self.verbose = False
@@ -36,14 +58,77 @@ def syntaxgym(state, verbose):
 @click.argument("model")
 @click.argument("suite_file", type=click.File("r"))
 @click.option("--checkpoint")
+@click.option("--cache/--no_cache", default=False,
+              help=("Store model outputs and token alignments in a persistent "
+                    "on-disk cache, and only send previously unseen "
+                    "sentences to the model."))
+@click.option("--single_pass/--separate_tokenize", default=False,
+              help=("Read model tokens from the surprisal output instead of "
+                    "running a separate tokenization pass."))
+@click.option("--chunk_size", type=int,
+              help=("If given, process this many items at a time and write "
+                    "results incrementally, bounding memory use."))
+@click.option("--sidecar", type=click.Path(dir_okay=False),
+              help=("Also save token-level surprisals to this file, from which "
+                    "region-level results can be recomputed with "
+                    "`syntaxgym reaggregate`."))
+@click.option("--alignment_workers", type=int, default=1, show_default=True,
+              help=("Align tokens with suite regions in up to this many "
+                    "processes, for suites with at least %i sentences."
+                    % S.agg_surprisals.PARALLEL_ALIGNMENT_THRESHOLD))
 @click.option("--tabular_results/--json_results",
               help=("If `--tabular_results`, outputs a TSV structured like the "
                     "output of :func:`syntaxgym.suite.Suite.as_dataframe`."),
               default=False)
 @pass_state
-def compute_surprisals(state, model, suite_file, checkpoint, tabular_results):
+def compute_surprisals(state, model, suite_file, checkpoint, cache, single_pass,
+                       chunk_size, sidecar, alignment_workers, tabular_results):
     model = _prepare_model(model, checkpoint)
-    result = S.compute_surprisals(model, suite_file)
+    caches = _prepare_caches(cache)
+
+    if chunk_size is not None:
+        if not tabular_results:
+            raise click.UsageError("--chunk_size requires --tabular_results")
+        if sidecar is not None:
+            raise click.UsageError("--sidecar is not supported with --chunk_size")
+
+        chunks = S.iter_compute_surprisals(model, suite_file,
+                                           chunk_size=chunk_size,
+                                           single_pass=single_pass,
+                                           alignment_workers=alignment_workers,
+                                           **caches)
+        for i, chunk in enumerate(chunks):
+            chunk.as_dataframe().to_csv(sys.stdout, sep="\t", header=i == 0)
+        return
+
+    result = S.compute_surprisals(model, suite_file, single_pass=single_pass,
+                                  sidecar=sidecar,
+                                  alignment_workers=alignment_workers, **caches)
+    if tabular_results:
+        result = result.as_dataframe()
+        result.to_csv(sys.stdout, sep="\t")
+    else:
+        json.dump(result.as_dict(), sys.stdout, indent=2)
+
+
+@syntaxgym.command(help=("Recompute per-region surprisals for the given test "
+                          "suite from token-level surprisals saved with "
+                          "`compute-surprisals --sidecar`, without running "
+                          "the model"))
+@click.argument("suite_file", type=click.File("r"))
+@click.argument("sidecar", type=click.Path(exists=True, dir_okay=False))
+@click.option("--alignment_workers", type=int, default=1, show_default=True,
+              help=("Align tokens with suite regions in up to this many "
+                    "processes, for suites with at least %i sentences."
+                    % S.agg_surprisals.PARALLEL_ALIGNMENT_THRESHOLD))
+@click.option("--tabular_results/--json_results",
+              help=("If `--tabular_results`, outputs a TSV structured like the "
+                    "output of :func:`syntaxgym.suite.Suite.as_dataframe`."),
+              default=False)
+@pass_state
+def reaggregate(state, suite_file, sidecar, alignment_workers, tabular_results):
+    result = S.reaggregate(suite_file, sidecar,
+                           alignment_workers=alignment_workers)
     if tabular_results:
         result = result.as_dataframe()
         result.to_csv(sys.stdout, sep="\t")
@@ -59,13 +144,110 @@ def evaluate(state, suite_file):
     result.to_csv(sys.stdout, sep="\t")
 
 
-@syntaxgym.command(help="Run the model and test suite through the full pipeline")
+@syntaxgym.command(help=("Run the model and test suite(s) through the full "
+                          "pipeline. Sentences from all suites are scored in a "
+                          "single model invocation."))
 @click.argument("model")
-@click.argument("suite_file", type=click.File("r"))
-@click.option("--checkpoint")
+@click.argument("suite_files", type=click.File("r"), nargs=-1, required=True)
+@click.option("--checkpoint", "checkpoints", multiple=True,
+              help=("Path to a custom model checkpoint. Repeat to sweep over "
+                    "several checkpoints."))
+@click.option("--checkpoint_dir", type=click.Path(exists=True, file_okay=False),
+              help=("Sweep over every checkpoint stored in this directory, "
+                    "ignoring hidden files."))
+@click.option("--cache/--no_cache", default=False,
+              help=("Store model outputs and token alignments in a persistent "
+                    "on-disk cache, and only send previously unseen "
+                    "sentences to the model."))
+@click.option("--single_pass/--separate_tokenize", default=False,
+              help=("Read model tokens from the surprisal output instead of "
+                    "running a separate tokenization pass."))
+@click.option("--chunk_size", type=int,
+              help=("If given, process this many items at a time and write "
+                    "results incrementally, bounding memory use."))
+@click.option("--alignment_workers", type=int, default=1, show_default=True,
+              help=("Align tokens with suite regions in up to this many "
+                    "processes, for suites with at least %i sentences."
+                    % S.agg_surprisals.PARALLEL_ALIGNMENT_THRESHOLD))
 @pass_state
-def run(state, model, suite_file, checkpoint):
-    model = _prepare_model(model, checkpoint)
-    suite = S.compute_surprisals(model, suite_file)
-    result = S.evaluate(suite)
+def run(state, model, suite_files, checkpoints, checkpoint_dir, cache,
+        single_pass, chunk_size, alignment_workers):
+    checkpoints = list(checkpoints)
+    sweep = checkpoint_dir is not None or len(checkpoints) > 1
+    if checkpoint_dir is not None:
+        dir_checkpoints = _list_checkpoints(checkpoint_dir)
+        if not dir_checkpoints:
+            raise click.UsageError("No checkpoints found in --checkpoint_dir %s"
+                                   % checkpoint_dir)
+        checkpoints.extend(dir_checkpoints)
+
+    caches = _prepare_caches(cache)
+
+    if sweep:
+        if chunk_size is not None:
+            raise click.UsageError("--chunk_size is not supported with "
+                                   "checkpoint sweeps")
+        if click.get_current_context().get_parameter_source("single_pass") \
+                != click.core.ParameterSource.DEFAULT:
+            raise click.UsageError("--single_pass/--separate_tokenize is not "
+                                   "supported with checkpoint sweeps, which "
+                                   "always tokenize once with the first "
+                                   "checkpoint")
+
+        # Sweep over checkpoints, tokenizing and aligning only once.
+        result = S.run_checkpoints(_prepare_model(model), suite_files,
+                                   checkpoints,
+                                   alignment_workers=alignment_workers,
+                                   **caches)
+        result.to_csv(sys.stdout, sep="\t")
+        return
+
+    model = _prepare_model(model, checkpoints[0] if checkpoints else None)
+
+    if chunk_size is not None:
+        # Evaluate and write results one chunk at a time.
+        chunks = (chunk for suite_file in suite_files
+                  for chunk in S.iter_compute_surprisals(
+                      model, suite_file, chunk_size=chunk_size,
+                      single_pass=single_pass,
+                      alignment_workers=alignment_workers, **caches))
+        for i, chunk in enumerate(chunks):
+            S.evaluate(chunk).to_csv(sys.stdout, sep="\t", header=i == 0)
+        return
+
+    suites = S.compute_surprisals_many(model, suite_files,
+                                       single_pass=single_pass,
+                                       alignment_workers=alignment_workers,
+                                       **caches)
+    result = pd.concat([S.evaluate(suite) for suite in suites])
+    result.to_csv(sys.stdout, sep="\t")
+
+
+@syntaxgym.command(help=("Run several models over the given test suite(s) "
+                          "concurrently, and output a single combined table "
+                          "of prediction results."))
+@click.argument("suite_files", type=click.File("r"), nargs=-1, required=True)
+@click.option("--model", "-m", "model_refs", multiple=True, required=True,
+              help="Model reference. May be repeated.")
+@click.option("--max_workers", type=int, default=4, show_default=True,
+              help="Maximum number of models to run concurrently.")
+@click.option("--cache/--no_cache", default=False,
+              help=("Store model outputs and token alignments in a persistent "
+                    "on-disk cache, and only send previously unseen "
+                    "sentences to the model."))
+@click.option("--single_pass/--separate_tokenize", default=False,
+              help=("Read model tokens from the surprisal output instead of "
+                    "running a separate tokenization pass."))
+@click.option("--alignment_workers", type=int, default=1, show_default=True,
+              help=("Align tokens with suite regions in up to this many "
+                    "processes, for suites with at least %i sentences."
+                    % S.agg_surprisals.PARALLEL_ALIGNMENT_THRESHOLD))
+@pass_state
+def run_models(state, suite_files, model_refs, max_workers, cache, single_pass,
+               alignment_workers):
+    models = {model_ref: _prepare_model(model_ref) for model_ref in model_refs}
+    result = S.run_models(models, suite_files, max_workers=max_workers,
+                          single_pass=single_pass,
+                          alignment_workers=alignment_workers,
+                          **_prepare_caches(cache))
     result.to_csv(sys.stdout, sep="\t")
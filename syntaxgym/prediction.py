@@ -1,28 +1,25 @@
-from typing import Union, Optional as TOptional, List as TList
+import functools
+import operator
+import re
+from typing import Callable, Union, Optional as TOptional, Dict as TDict, \
+    List as TList
 
-
-from pyparsing import *
 import numpy as np
 
 from syntaxgym.utils import METRICS
 
-
-# Enable parser packrat (caching)
-ParserElement.enablePackrat()
-
 # Relative and absolute tolerance thresholds for surprisal equality
 EQUALITY_RTOL = 1e-5
 EQUALITY_ATOL = 1e-3
 
 
-#######
-# Define a grammar for prediction formulae.
+def _isclose(a, b):
+    return np.isclose(a, b, rtol=EQUALITY_RTOL, atol=EQUALITY_ATOL)
+
 
-# References a surprisal region
-lpar = Suppress("(")
-rpar = Suppress(")")
-region = lpar + (Word(nums) | "*") + Suppress(";%") + Word(alphanums + "_-") + Suppress("%") + rpar
-literal_float = pyparsing_common.number
+#######
+# Formula tree nodes. The grammar which builds these from formula strings is
+# defined below.
 
 class Region(object):
     def __init__(self, tokens):
@@ -42,6 +39,16 @@ class Region(object):
 
         return surprisal_dict[self.condition_name, int(self.region_number)]
 
+    def compile(self, vectorized=False):
+        condition_name = self.condition_name
+        if self.region_number == "*":
+            def region_sum(surprisal_dict):
+                return sum(value for (condition, region), value in surprisal_dict.items()
+                           if condition == condition_name)
+            return region_sum
+
+        return operator.itemgetter((condition_name, int(self.region_number)))
+
 class LiteralFloat(object):
     def __init__(self, tokens):
         self.value = float(tokens[0])
@@ -55,8 +62,14 @@ class LiteralFloat(object):
     def __call__(self, surprisal_dict):
         return self.value
 
+    def compile(self, vectorized=False):
+        value = self.value
+        return lambda surprisal_dict: value
+
 class BinaryOp(object):
     operators: TOptional[TList[str]]
+    operator_fns: TDict[str, Callable] = {}
+    vector_operator_fns: TOptional[TDict[str, Callable]] = None
 
     def __init__(self, tokens):
         self.operator = tokens[0][1]
@@ -75,36 +88,58 @@ class BinaryOp(object):
         op_vals = [op(surprisal_dict) for op in self.operands]
         return self._evaluate(op_vals, surprisal_dict)
 
-    def _evaluate(self, evaluated_operands, surprisal_dict):
-        raise NotImplementedError()
+    def _evaluate(self, op_vals, surprisal_dict):
+        return self.operator_fns[self.operator](*op_vals)
+
+    def compile(self, vectorized=False) -> Callable:
+        """
+        Compile this formula into a single function of a surprisal dict. Each
+        node's operator is resolved once here, rather than on every
+        evaluation.
+
+        Args:
+            vectorized: If ``True``, the compiled function instead accepts a
+                dict whose values are arrays of metric values across many
+                items, and returns an array of per-item results.
+        """
+        operator_fns = self.operator_fns
+        if vectorized and self.vector_operator_fns is not None:
+            operator_fns = self.vector_operator_fns
+        op_fn = operator_fns[self.operator]
+        left, right = [operand.compile(vectorized) for operand in self.operands]
+
+        def evaluate(surprisal_dict):
+            # NB both operands are always evaluated, as in `__call__`.
+            return op_fn(left(surprisal_dict), right(surprisal_dict))
+        return evaluate
 
 class BoolOp(BinaryOp):
     operators = ["&", "|"]
-    def _evaluate(self, op_vals, surprisal_dict):
-        if self.operator == "&":
-            return op_vals[0] and op_vals[1]
-        elif self.operator == "|":
-            return op_vals[0] or op_vals[1]
+    operator_fns = {
+        "&": lambda a, b: a and b,
+        "|": lambda a, b: a or b,
+    }
+    # Elementwise versions of `and` and `or`, which return one of their
+    # operands just like their scalar counterparts.
+    vector_operator_fns = {
+        "&": lambda a, b: np.where(a, b, a),
+        "|": lambda a, b: np.where(a, a, b),
+    }
 
 class FloatOp(BinaryOp):
     operators = ["-", "+"]
-    def _evaluate(self, op_vals, surprisal_dict):
-        if self.operator == "-":
-            return op_vals[0] - op_vals[1]
-        elif self.operator == "+":
-            return op_vals[0] + op_vals[1]
+    operator_fns = {
+        "-": operator.sub,
+        "+": operator.add,
+    }
 
 class ComparatorOp(BinaryOp):
     operators = ["<", ">", "="]
-    def _evaluate(self, op_vals, surprisal_dict):
-        if self.operator == "<":
-            return op_vals[0] < op_vals[1]
-        elif self.operator == ">":
-            return op_vals[0] > op_vals[1]
-        elif self.operator == "=":
-            return np.isclose(op_vals[0], op_vals[1],
-                                rtol=EQUALITY_RTOL,
-                                atol=EQUALITY_ATOL)
+    operator_fns = {
+        "<": operator.lt,
+        ">": operator.gt,
+        "=": _isclose,
+    }
 
 def Chain(op_cls, left_assoc=True):
     def chainer(tokens):
@@ -127,17 +162,176 @@ def Chain(op_cls, left_assoc=True):
 
     return chainer
 
-atom = region.setParseAction(Region) | literal_float.setParseAction(LiteralFloat)
 
-prediction_expr = infixNotation(
-    atom,
-    [
-        (oneOf("- +"), 2, opAssoc.LEFT, Chain(FloatOp)),
-        (oneOf("< > ="), 2, opAssoc.LEFT, ComparatorOp),
-        (oneOf("& |"), 2, opAssoc.LEFT, Chain(BoolOp)),
-    ],
-    lpar=lpar, rpar=rpar
-)
+#######
+# Define a grammar for prediction formulae. Building the grammar (and
+# importing pyparsing) is relatively slow, so this is deferred until the
+# first formula is parsed with it.
+
+@functools.lru_cache(maxsize=None)
+def get_prediction_grammar():
+    """
+    Get the pyparsing grammar for prediction formulae, building it on first
+    use. Parsing a formula string with this grammar yields a formula tree.
+    """
+    from pyparsing import ParserElement, Suppress, Word, alphanums, \
+        infixNotation, nums, oneOf, opAssoc, pyparsing_common
+
+    # Enable parser packrat (caching)
+    ParserElement.enablePackrat()
+
+    # References a surprisal region
+    lpar = Suppress("(")
+    rpar = Suppress(")")
+    region = lpar + (Word(nums) | "*") + Suppress(";%") + Word(alphanums + "_-") + Suppress("%") + rpar
+    literal_float = pyparsing_common.number
+
+    atom = region.setParseAction(Region) | literal_float.setParseAction(LiteralFloat)
+
+    return infixNotation(
+        atom,
+        [
+            (oneOf("- +"), 2, opAssoc.LEFT, Chain(FloatOp)),
+            (oneOf("< > ="), 2, opAssoc.LEFT, ComparatorOp),
+            (oneOf("& |"), 2, opAssoc.LEFT, Chain(BoolOp)),
+        ],
+        lpar=lpar, rpar=rpar
+    )
+
+
+def __getattr__(name):
+    # Backwards compatibility: `prediction_expr` used to be built at import.
+    if name == "prediction_expr":
+        return get_prediction_grammar()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+#######
+# A hand-written recursive-descent parser for the same grammar, which builds
+# the same formula trees as `get_prediction_grammar()` much faster.
+
+# Same whitespace as pyparsing.
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_REGION = re.compile(r"\([ \t\n\r]*([0-9]+|\*)[ \t\n\r]*;%[ \t\n\r]*"
+                     r"([A-Za-z0-9_-]+)[ \t\n\r]*%[ \t\n\r]*\)")
+# Alternatives of `pyparsing_common.number` (scientific notation, real,
+# signed integer), tried in the same order.
+_NUMBER = re.compile(r"[+-]?(?:\d+(?:[eE][+-]?\d+)|(?:\d+\.\d*|\.\d+)(?:[eE][+-]?\d+)?)"
+                     r"|[+-]?(?:\d+\.\d*|\.\d+)"
+                     r"|[+-]?\d+")
+
+# Operator characters and parse actions for each precedence level, from
+# tightest to loosest binding, as in `get_prediction_grammar()`.
+_LEVELS = [
+    ("-+", Chain(FloatOp)),
+    ("<>=", ComparatorOp),
+    ("&|", Chain(BoolOp)),
+]
+
+
+class _NoMatch(Exception):
+    pass
+
+
+def _parse_operand(formula: str, pos: int):
+    pos = _WHITESPACE.match(formula, pos).end()
+
+    match = _REGION.match(formula, pos)
+    if match is not None:
+        return match.end(), Region([match.group(1), match.group(2)])
+
+    match = _NUMBER.match(formula, pos)
+    if match is not None:
+        return match.end(), LiteralFloat([match.group(0)])
+
+    if formula.startswith("(", pos):
+        pos, expr = _parse_level(formula, pos + 1, len(_LEVELS) - 1)
+        pos = _WHITESPACE.match(formula, pos).end()
+        if formula.startswith(")", pos):
+            return pos + 1, expr
+
+    raise _NoMatch()
+
+
+def _parse_level(formula: str, pos: int, level: int):
+    if level < 0:
+        return _parse_operand(formula, pos)
+
+    operators, action = _LEVELS[level]
+    pos, operand = _parse_level(formula, pos, level - 1)
+    tokens = [operand]
+    while True:
+        op_pos = _WHITESPACE.match(formula, pos).end()
+        if op_pos == len(formula) or formula[op_pos] not in operators:
+            break
+
+        # NB an operator must be followed by an operand; nothing else in the
+        # grammar could consume it.
+        pos, operand = _parse_level(formula, op_pos + 1, level - 1)
+        tokens.extend([formula[op_pos], operand])
+
+    if len(tokens) == 1:
+        return pos, operand
+    return pos, action([tokens])
+
+
+def _parse_formula_fast(formula: str):
+    """
+    Parse a formula with the recursive-descent parser. Raises
+    :class:`_NoMatch` on any syntax error.
+    """
+    pos, expr = _parse_level(formula, 0, len(_LEVELS) - 1)
+    if _WHITESPACE.match(formula, pos).end() != len(formula):
+        raise _NoMatch()
+    return expr
+
+
+FORMULA_CACHE_SIZE = 4096
+"""
+Maximum number of parsed formulas memoized by :func:`parse_formula`.
+"""
+
+
+@functools.lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def parse_formula(formula: str, fast: bool = True):
+    """
+    Parse a prediction formula string. Parsed formulas are memoized by
+    formula text, and so may be shared across predictions; they must not be
+    modified.
+
+    Args:
+        formula: Formula string. For more information, see
+            :ref:`architecture`.
+        fast: If ``True``, parse with a hand-written recursive-descent
+            parser, which produces the same formula trees as the pyparsing
+            grammar. Formulas it rejects are passed on to the pyparsing
+            grammar, which then reports the error.
+
+    Raises:
+        ValueError: If ``formula`` is not a valid formula.
+    """
+    if fast:
+        try:
+            return _parse_formula_fast(formula)
+        except (_NoMatch, RecursionError):
+            pass
+
+    from pyparsing import ParseException
+    try:
+        return get_prediction_grammar().parseString(formula, parseAll=True)[0]
+    except ParseException as e:
+        raise ValueError("Invalid formula expression %r" % (formula,)) from e
+
+
+def surprisal_lookup(item, metric: str) -> dict:
+    """
+    Build a dict mapping ``(condition_name, region_number)`` pairs to the
+    value of ``metric`` in the corresponding region of the given item dict.
+    This can be shared by all predictions which use the same metric.
+    """
+    return {(c["condition_name"], r["region_number"]): r["metric_value"][metric]
+            for c in item["conditions"]
+            for r in c["regions"]}
 
 
 class Prediction(object):
@@ -147,7 +341,8 @@ class Prediction(object):
     information, see :ref:`architecture`.
     """
 
-    def __init__(self, idx: int, formula: Union[str, BinaryOp], metric: str):
+    def __init__(self, idx: int, formula: Union[str, BinaryOp], metric: str,
+                 declare_metric: bool = False):
         """
         Args:
             idx: A unique prediction ID. This is only relevant for
@@ -156,42 +351,80 @@ class Prediction(object):
                 already parsed formula. For more information, see
                 :ref:`architecture`.
             metric: Metric for aggregating surprisals within regions.
+            declare_metric: If ``True``, include ``metric`` in this
+                prediction's dictionary representation, rather than relying
+                on the suite's metric.
         """
         if isinstance(formula, str):
-            try:
-                formula = prediction_expr.parseString(formula, parseAll=True)[0]
-            except ParseException as e:
-                raise ValueError("Invalid formula expression %r" % (formula,)) from e
+            formula = parse_formula(formula)
 
         self.idx = idx
         self.formula = formula
+        self._compiled = None
+        self._compiled_vectorized = None
 
         if metric not in METRICS.keys():
             raise ValueError("Unknown metric %s. Supported metrics: %s" %
                              (metric, " ".join(METRICS.keys())))
         self.metric = metric
+        self.declare_metric = declare_metric
 
     def __call__(self, item):
         """
         Evaluate the prediction on the given item dict representation. For more
         information on item representations, see :ref:`suite_json`.
         """
-        # Prepare relevant surprisal dict
-        surps = {(c["condition_name"], r["region_number"]): r["metric_value"][self.metric]
-                 for c in item["conditions"]
-                 for r in c["regions"]}
-        return self.formula(surps)
+        return self.evaluate(surprisal_lookup(item, self.metric))
+
+    def evaluate(self, surprisal_dict):
+        """
+        Evaluate the prediction given a dict of an item's metric values, as
+        returned by :func:`surprisal_lookup` for this prediction's metric.
+        """
+        if self._compiled is None:
+            self._compiled = self.formula.compile()
+        return self._compiled(surprisal_dict)
+
+    def evaluate_columns(self, surprisal_columns, n_items: int) -> np.ndarray:
+        """
+        Evaluate the prediction on many items at once.
+
+        Args:
+            surprisal_columns: A dict mapping each ``(condition_name,
+                region_number)`` pair to an array of the corresponding
+                region's metric value in each item.
+            n_items: Number of items.
+
+        Returns:
+            An array of ``n_items`` prediction results
+        """
+        if self._compiled_vectorized is None:
+            self._compiled_vectorized = self.formula.compile(vectorized=True)
+        return np.broadcast_to(self._compiled_vectorized(surprisal_columns),
+                               (n_items,))
+
+    def __getstate__(self):
+        # Compiled formulas are closures, which can't be pickled.
+        state = dict(self.__dict__)
+        state["_compiled"] = state["_compiled_vectorized"] = None
+        return state
 
     @classmethod
     def from_dict(cls, pred_dict, idx: int, metric: str):
         """
         Parse from a prediction dictionary representation (see
         :ref:`suite_json`).
+
+        Args:
+            metric: Default metric, used unless the prediction declares its
+                own ``metric``.
         """
         if not pred_dict["type"] == "formula":
             raise ValueError("Unknown prediction type %s" % (pred_dict["type"],))
 
-        return cls(formula=pred_dict["formula"], idx=idx, metric=metric)
+        return cls(formula=pred_dict["formula"], idx=idx,
+                   metric=pred_dict.get("metric", metric),
+                   declare_metric="metric" in pred_dict)
 
     @property
     def referenced_regions(self):
@@ -215,14 +448,19 @@ class Prediction(object):
         Serialize as a prediction dictionary representation (see
         :ref:`suite_json`).
         """
-        return dict(type="formula", formula=str(self.formula))
+        ret = dict(type="formula", formula=str(self.formula))
+        if self.declare_metric:
+            ret["metric"] = self.metric
+        return ret
 
     def __str__(self):
         return "Prediction(%s)" % (self.formula,)
     __repr__ = __str__
 
     def __hash__(self):
-        return hash(self.formula)
+        # Parsed formulas are shared between predictions with the same
+        # formula text, so also distinguish predictions by ID and metric.
+        return hash((self.idx, self.formula, self.metric))
 
     def __eq__(self, other):
         return isinstance(other, Prediction) and hash(self) == hash(other)
@@ -0,0 +1,257 @@
+"""
+Defines methods for retrieving token-level surprisals and tokenizations from
+language models, minimizing the amount of work sent to the model.
+"""
+
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from lm_zoo import get_surprisals, tokenize
+from lm_zoo.models import Model, DummyModel
+
+from syntaxgym.cache import CachedSentence, SurprisalCache, model_cache_key
+
+L = logging.getLogger(__name__)
+
+
+def _is_precomputed(model: Model) -> bool:
+    """
+    Returns ``True`` if the given model serves precomputed outputs for a fixed
+    list of sentences, in which case we can't change the sentences we send it.
+
+    NB, subclasses of ``DummyModel`` may compute outputs for arbitrary
+    sentences, so we only match the LM Zoo class exactly.
+    """
+    return type(model) is DummyModel
+
+
+def deduplicate_sentences(sentences: List[str]) -> Tuple[List[str], np.ndarray]:
+    """
+    Find the unique sentences in ``sentences``, preserving first-occurrence
+    order.
+
+    Returns:
+        unique_sentences: List of unique sentence strings
+        inverse: An integer array mapping each element of ``sentences`` to
+            the index of the corresponding sentence in ``unique_sentences``
+    """
+    unique_idxs = {}
+    inverse = np.empty(len(sentences), dtype=int)
+    for i, sentence in enumerate(sentences):
+        inverse[i] = unique_idxs.setdefault(sentence, len(unique_idxs))
+
+    return list(unique_idxs.keys()), inverse
+
+
+def _sentence_offsets(sentence_ids: np.ndarray, n: int) -> np.ndarray:
+    """
+    Given the sorted ``sentence_id`` column of a surprisal data frame, compute
+    the row offset at which each of sentences ``1..n`` begins. The returned
+    array has ``n + 1`` elements, with the last marking the end of the frame.
+    """
+    return np.searchsorted(sentence_ids, np.arange(1, n + 2))
+
+
+def flatten_surprisals(surprisals: pd.DataFrame, n: int
+                       ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Convert a ``get_surprisals`` data frame describing ``n`` sentences into
+    flat arrays, so that each sentence's outputs can be retrieved by slicing
+    rather than by index lookups.
+
+    Returns:
+        tokens: Array of all tokens, ordered by sentence
+        surprisals: Float array of the corresponding surprisals
+        offsets: Array of ``n + 1`` row offsets, such that sentence ``i``
+            (numbered from 0) spans rows ``offsets[i]:offsets[i + 1]``
+    """
+    surprisals = surprisals.reset_index() \
+        .sort_values("sentence_id", kind="stable")
+    offsets = _sentence_offsets(surprisals.sentence_id.values, n)
+    return (surprisals.token.values,
+            surprisals.surprisal.values.astype(np.float64),
+            offsets)
+
+
+def slice_surprisals(surprisals: pd.DataFrame, start: int, n: int) -> pd.DataFrame:
+    """
+    Extract the surprisal rows for sentences ``start + 1`` through ``start +
+    n`` from the output of a batched ``get_surprisals`` call, renumbering
+    sentence IDs to begin at 1.
+    """
+    surprisals = surprisals.reset_index()
+    ret = surprisals[surprisals.sentence_id.between(start + 1, start + n)].copy()
+    ret["sentence_id"] -= start
+    return ret.set_index(["sentence_id", "token_id"])
+
+
+def expand_surprisals(surprisals: pd.DataFrame, inverse: np.ndarray) -> pd.DataFrame:
+    """
+    Fan out a surprisal data frame computed on deduplicated sentences to the
+    original list of sentences.
+
+    Args:
+        surprisals: ``get_surprisals`` output computed on unique sentences
+        inverse: Mapping from original sentence index to unique sentence
+            index, as returned by :func:`deduplicate_sentences`
+
+    Returns:
+        A surprisal data frame with one sentence for each element of
+        ``inverse``, numbered from 1
+    """
+    surprisals = surprisals.reset_index() \
+        .sort_values("sentence_id", kind="stable")
+
+    # Locate the rows belonging to each unique sentence.
+    n_unique = inverse.max() + 1 if len(inverse) else 0
+    unique_starts = _sentence_offsets(surprisals.sentence_id.values, n_unique)
+    unique_lengths = np.diff(unique_starts)
+
+    # Build a row index which repeats each unique sentence's rows once for
+    # every original sentence that uses it.
+    lengths = unique_lengths[inverse]
+    starts = np.cumsum(lengths) - lengths
+    rows = np.arange(lengths.sum()) + np.repeat(unique_starts[:-1][inverse] - starts, lengths)
+
+    ret = surprisals.iloc[rows].copy()
+    ret["sentence_id"] = np.repeat(np.arange(1, len(inverse) + 1), lengths)
+    return ret.set_index(["sentence_id", "token_id"])
+
+
+def split_surprisals(surprisals: pd.DataFrame, tokens: List[List[str]]
+                     ) -> List[CachedSentence]:
+    """
+    Split model outputs for a list of sentences into per-sentence records.
+    """
+    surprisal_tokens, surprisal_values, offsets = \
+        flatten_surprisals(surprisals, len(tokens))
+
+    return [CachedSentence(sent_tokens,
+                           list(surprisal_tokens[start:end]),
+                           surprisal_values[start:end])
+            for sent_tokens, start, end
+            in zip(tokens, offsets[:-1], offsets[1:])]
+
+
+def join_surprisals(sentences: List[CachedSentence]) -> pd.DataFrame:
+    """
+    Build a ``get_surprisals`` data frame from per-sentence records.
+    """
+    lengths = [len(sentence.surprisals) for sentence in sentences]
+    df = pd.DataFrame({
+        "sentence_id": np.repeat(np.arange(1, len(sentences) + 1), lengths),
+        "token_id": np.concatenate([np.arange(1, length + 1) for length in lengths])
+                    if sentences else np.array([], dtype=int),
+        "token": [token for sentence in sentences
+                  for token in sentence.surprisal_tokens],
+        "surprisal": np.concatenate([sentence.surprisals for sentence in sentences])
+                     if sentences else np.array([]),
+    })
+    return df.set_index(["sentence_id", "token_id"])
+
+
+def tokens_from_surprisals(surprisals: pd.DataFrame, n: int) -> List[List[str]]:
+    """
+    Read off per-sentence token lists from the ``token`` column of a
+    ``get_surprisals`` data frame describing ``n`` sentences.
+    """
+    tokens, _, offsets = flatten_surprisals(surprisals, n)
+    return [list(tokens[start:end])
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _run_model(model: Model, sentences: List[str], single_pass=False
+               ) -> Tuple[pd.DataFrame, List[List[str]]]:
+    """
+    Retrieve surprisals and tokenizations from the model. If ``single_pass``
+    is ``True``, tokens are read from the surprisal output rather than
+    retrieved with a separate ``tokenize`` call.
+    """
+    surprisals = get_surprisals(model, sentences)
+    if single_pass:
+        tokens = tokens_from_surprisals(surprisals, len(sentences))
+    else:
+        tokens = tokenize(model, sentences)
+
+    return surprisals, tokens
+
+
+def _score_with_cache(model: Model, sentences: List[str], cache: SurprisalCache,
+                      single_pass=False) -> Tuple[pd.DataFrame, List[List[str]]]:
+    """
+    Compute surprisals and tokenizations for unique ``sentences``, only
+    sending cache misses to the model.
+    """
+    try:
+        model_key = model_cache_key(model)
+    except ValueError as e:
+        # Never risk serving stale outputs for a model we can't identify.
+        L.warning("Not using surprisal cache: %s", e)
+        return _run_model(model, sentences, single_pass=single_pass)
+
+    results = cache.get_many(model_key, sentences)
+
+    misses = [sentence for sentence in sentences if sentence not in results]
+    L.info("Surprisal cache: %i hits, %i misses",
+           len(sentences) - len(misses), len(misses))
+
+    if misses:
+        miss_results = split_surprisals(
+            *_run_model(model, misses, single_pass=single_pass))
+        miss_results = dict(zip(misses, miss_results))
+        cache.put_many(model_key, miss_results)
+        results.update(miss_results)
+
+    results = [results[sentence] for sentence in sentences]
+    return join_surprisals(results), [result.tokens for result in results]
+
+
+def score_sentences(model: Model, sentences: List[str], dedup=True,
+                    cache: Optional[SurprisalCache] = None, single_pass=False
+                    ) -> Tuple[pd.DataFrame, List[List[str]]]:
+    """
+    Compute token-level surprisals and tokenizations for the given sentences.
+
+    Args:
+        model: An LM Zoo ``Model``.
+        sentences: List of natural-language sentences.
+        dedup: If ``True``, send each unique sentence to the model only once
+            and fan out the results to all of its occurrences.
+        cache: If not ``None``, look up sentences in this persistent cache
+            and only send cache misses to the model. Implies ``dedup``.
+            The cache is skipped, with a warning, for models whose weights
+            can't be identified by content (e.g. an unpulled image or a
+            missing checkpoint path).
+        single_pass: If ``True``, read tokens from the ``get_surprisals``
+            output instead of making a separate ``tokenize`` call. This
+            halves the number of model runs.
+
+    ``dedup`` and ``cache`` are ignored for models which serve precomputed
+    outputs.
+
+    Returns:
+        surprisals: A ``get_surprisals`` data frame, with one sentence per
+            element of ``sentences``
+        tokens: A ``tokenize`` result, with one token list per element of
+            ``sentences``
+    """
+    if _is_precomputed(model) or (not dedup and cache is None):
+        return _run_model(model, sentences, single_pass=single_pass)
+
+    unique_sentences, inverse = deduplicate_sentences(sentences)
+    if sentences:
+        L.info("Scoring %i unique sentences out of %i (dedup ratio %.3f)",
+               len(unique_sentences), len(sentences),
+               len(unique_sentences) / len(sentences))
+
+    if cache is not None:
+        surprisals, tokens = _score_with_cache(model, unique_sentences, cache,
+                                               single_pass=single_pass)
+    else:
+        surprisals, tokens = _run_model(model, unique_sentences,
+                                        single_pass=single_pass)
+
+    return expand_surprisals(surprisals, inverse), [tokens[i] for i in inverse]
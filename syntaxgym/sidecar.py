@@ -0,0 +1,159 @@
+"""
+Defines a compact on-disk record of the token-level model outputs behind an
+evaluated suite, so that region-level metrics can be recomputed later without
+running the model again.
+"""
+
+import json
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+import numpy as np
+
+SIDECAR_VERSION = 1
+"""
+Version of the sidecar file format written by :meth:`Sidecar.save`.
+"""
+
+
+class Sidecar(NamedTuple):
+    """
+    Token-level model outputs for the sentences of a suite, stored as flat
+    arrays, along with the token-to-region segmentation computed for the
+    suite.
+    """
+
+    spec: dict
+    """
+    LM Zoo spec of the model which produced these outputs
+    """
+
+    sentences: List[str]
+    """
+    Suite sentences, in suite order
+    """
+
+    tokens: np.ndarray
+    """
+    Flat array of all sentence tokens
+    """
+
+    surprisals: np.ndarray
+    """
+    Float array of the surprisal of each token
+    """
+
+    offsets: np.ndarray
+    """
+    Array of ``len(sentences) + 1`` token offsets, such that sentence ``i``
+    spans ``tokens[offsets[i]:offsets[i + 1]]``
+    """
+
+    suite_fingerprint: str
+    """
+    Fingerprint of the suite regions were aligned with. See
+    :func:`~syntaxgym.cache.suite_fingerprint`.
+    """
+
+    region_starts: np.ndarray
+    """
+    Offset in :attr:`tokens` of the first token of each region of the suite,
+    in suite order
+    """
+
+    region_lengths: np.ndarray
+    """
+    Number of tokens in each region
+    """
+
+    region_oovs: List[List[str]]
+    """
+    OOV spans in each region
+    """
+
+    def save(self, path: Union[str, Path]):
+        """
+        Write this sidecar to a compressed ``.npz`` file at ``path``.
+        """
+        # Write to an open file, so that numpy doesn't add a file extension.
+        with open(path, "wb") as f:
+            np.savez_compressed(
+                f,
+                version=np.array(SIDECAR_VERSION),
+                spec=np.array(json.dumps(self.spec)),
+                sentences=np.array(self.sentences, dtype=str),
+                tokens=np.asarray(self.tokens, dtype=str),
+                surprisals=np.asarray(self.surprisals, dtype=np.float64),
+                offsets=np.asarray(self.offsets, dtype=np.int64),
+                suite_fingerprint=np.array(self.suite_fingerprint),
+                region_starts=np.asarray(self.region_starts, dtype=np.int64),
+                region_lengths=np.asarray(self.region_lengths, dtype=np.int64),
+                region_oovs=np.array(json.dumps(self.region_oovs)))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "Sidecar":
+        """
+        Read a sidecar written by :meth:`save`.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != SIDECAR_VERSION:
+                raise ValueError("Unsupported sidecar version %i in %s"
+                                 % (int(data["version"]), path))
+
+            return cls(spec=json.loads(data["spec"].item()),
+                       sentences=data["sentences"].tolist(),
+                       tokens=data["tokens"],
+                       surprisals=data["surprisals"],
+                       offsets=data["offsets"],
+                       suite_fingerprint=data["suite_fingerprint"].item(),
+                       region_starts=data["region_starts"],
+                       region_lengths=data["region_lengths"],
+                       region_oovs=json.loads(data["region_oovs"].item()))
+
+    def region_surprisals(self) -> np.ndarray:
+        """
+        Gather the surprisals of each region's tokens into one flat array, in
+        region order.
+        """
+        # Shift each region's run of output positions to its token offset.
+        out_starts = np.cumsum(self.region_lengths) - self.region_lengths
+        idxs = np.arange(self.region_lengths.sum()) \
+            + np.repeat(self.region_starts - out_starts, self.region_lengths)
+        return self.surprisals[idxs]
+
+    def select_sentences(self, sentences: List[str]
+                         ) -> Tuple[List[List[str]], np.ndarray, np.ndarray]:
+        """
+        Retrieve the stored outputs for each of ``sentences``, which may be
+        ordered differently from (or be a subset of) the stored sentences.
+
+        Returns:
+            tokens: A ``tokenize`` result, with one token list per sentence
+            surprisals: Flat array of the surprisals of all tokens
+            offsets: Array of ``len(sentences) + 1`` offsets into
+                ``surprisals``, as in :attr:`offsets`
+
+        Raises:
+            ValueError: If any sentence has no stored outputs.
+        """
+        sentence_idxs: Dict[str, int] = {}
+        for idx, sentence in enumerate(self.sentences):
+            sentence_idxs.setdefault(sentence, idx)
+
+        missing = [sentence for sentence in sentences
+                   if sentence not in sentence_idxs]
+        if missing:
+            raise ValueError("%i sentence(s) have no stored model outputs, e.g. "
+                             "\"%s\". Re-run the model on this suite."
+                             % (len(missing), missing[0]))
+
+        idxs = np.array([sentence_idxs[sentence] for sentence in sentences],
+                        dtype=int)
+        starts, ends = self.offsets[idxs], self.offsets[idxs + 1]
+        lengths = ends - starts
+
+        tokens = [self.tokens[start:end].tolist()
+                  for start, end in zip(starts, ends)]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+        rows = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        return tokens, self.surprisals[rows], offsets
@@ -1,13 +1,37 @@
 from __future__ import annotations
 
+from collections.abc import Mapping
 import json
 from pprint import pformat
 import re
-from typing import Dict, List, Optional, Iterator
+from typing import Any, Dict, List, Optional, Iterator, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 
-from syntaxgym.prediction import Prediction
+from syntaxgym import utils
+from syntaxgym.prediction import Prediction, surprisal_lookup
+
+
+def _region_keys(items) -> Optional[List[Tuple[str, int]]]:
+    """
+    Get the ``(condition_name, region_number)`` pairs of each item's regions,
+    in order, if these are the same for all items and contain no duplicates.
+    Otherwise return ``None``.
+    """
+    keys = None
+    for item in items:
+        item_keys = [(cond["condition_name"], region["region_number"])
+                     for cond in item["conditions"]
+                     for region in cond["regions"]]
+        if keys is None:
+            if len(set(item_keys)) != len(item_keys):
+                return None
+            keys = item_keys
+        elif item_keys != keys:
+            return None
+
+    return keys
 
 
 class Suite(object):
@@ -88,13 +112,28 @@ class Suite(object):
                         condition["condition_name"],
                         region["region_number"],
                         region["content"],
-                        region["metric_value"][self.meta["metric"]],
+                        region["metric_value"][metric],
                         ",".join(region["oovs"])
                     ))
 
         ret = pd.DataFrame(ret, columns=columns).set_index(index_columns)
         return ret
 
+    def iter_chunks(self, chunk_size: int) -> Iterator[Suite]:
+        """
+        Split the suite into consecutive sub-suites of at most ``chunk_size``
+        items each. Sub-suites share metadata and predictions with this suite.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+
+        for start in range(0, len(self.items), chunk_size):
+            yield Suite(condition_names=self.condition_names,
+                        region_names=self.region_names,
+                        items=self.items[start:start + chunk_size],
+                        predictions=self.predictions,
+                        meta=self.meta)
+
     def iter_sentences(self) -> Iterator[str]:
         """
         Iterate over all sentences in the suite in fixed order.
@@ -139,12 +178,70 @@ class Suite(object):
             results: a nested dict mapping ``(item_number => prediction =>
                 prediction_result)``
         """
+        result = self._evaluate_predictions_dense(self.items)
+        if result is not None:
+            return result
+
+        return self._evaluate_predictions_itemwise(self.items)
 
+    def _evaluate_predictions_itemwise(self, items
+                                       ) -> Dict[int, Dict[Prediction, bool]]:
+        # Build each item's surprisal lookup once per metric, and share it
+        # across all predictions using that metric.
+        metrics = {prediction.metric for prediction in self.predictions}
         result: Dict[int, Dict[Prediction, bool]] = {}
-        for item in self.items:
+        for item in items:
+            lookups = {metric: surprisal_lookup(item, metric) for metric in metrics}
             result[item["item_number"]] = {}
             for prediction in self.predictions:
-                result[item["item_number"]][prediction] = prediction(item)
+                result[item["item_number"]][prediction] = \
+                    prediction.evaluate(lookups[prediction.metric])
+
+        return result
+
+    def _metric_matrix(self, metric: str) -> np.ndarray:
+        """
+        Collect the values of ``metric`` into an array with one row per item
+        and one column per region, with columns ordered as in
+        :func:`_region_keys`. Assumes all items share the same structure.
+        """
+        return np.array([[region["metric_value"][metric]
+                          for cond in item["conditions"]
+                          for region in cond["regions"]]
+                         for item in self.items], dtype=float)
+
+    def _evaluate_predictions_dense(self, items
+                                    ) -> Optional[Dict[int, Dict[Prediction, bool]]]:
+        """
+        Evaluate predictions on all items at once, over whole columns of a
+        dense (items × conditions × regions) metric tensor.
+
+        Returns ``None`` if items differ in their conditions or regions, or
+        lack metric values, in which case predictions must be evaluated item
+        by item.
+        """
+        keys = _region_keys(items)
+        if not items or keys is None:
+            return None
+
+        try:
+            matrices = {metric: self._metric_matrix(metric)
+                        for metric in {prediction.metric
+                                       for prediction in self.predictions}}
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        columns = {metric: dict(zip(keys, np.ascontiguousarray(matrix.T)))
+                   for metric, matrix in matrices.items()}
+        prediction_results = [
+            (prediction, prediction.evaluate_columns(
+                columns[prediction.metric], len(items)).tolist())
+            for prediction in self.predictions]
+
+        result: Dict[int, Dict[Prediction, bool]] = {}
+        for i, item in enumerate(items):
+            result[item["item_number"]] = {
+                prediction: values[i] for prediction, values in prediction_results}
 
         return result
 
@@ -152,6 +249,222 @@ class Suite(object):
         return isinstance(other, Suite) and json.dumps(self.as_dict()) == json.dumps(other.as_dict())
 
 
+class RegionMetrics(Mapping):
+    """
+    A read-only mapping from metric names to per-region metric values, which
+    retains the token-level surprisals of each region and computes each metric
+    (for all regions at once) only when it is first accessed.
+    """
+
+    def __init__(self, metrics: Sequence[str], surprisals: np.ndarray,
+                 region_lengths: Sequence[int]):
+        """
+        Args:
+            metrics: Names of the metrics in :data:`~syntaxgym.utils.METRICS`
+                available from this mapping.
+            surprisals: Flat array of token surprisals, the concatenation of
+                the tokens of every region in suite order.
+            region_lengths: Number of tokens in each region.
+        """
+        self.metrics = list(metrics)
+        self.surprisals = np.asarray(surprisals, dtype=np.float64)
+        self.region_lengths = np.asarray(region_lengths, dtype=int)
+        self._values: Dict[str, List[float]] = {}
+
+        if self.region_lengths.sum() != len(self.surprisals):
+            raise ValueError("Region lengths do not cover surprisals array")
+
+    @property
+    def n_regions(self) -> int:
+        return len(self.region_lengths)
+
+    def __getitem__(self, metric: str) -> List[float]:
+        if metric not in self.metrics:
+            raise KeyError(metric)
+
+        if metric not in self._values:
+            values = utils.aggregate_segments(self.surprisals, self.region_lengths,
+                                              [metric])[metric]
+            self._values[metric] = values.tolist()
+        return self._values[metric]
+
+    def __iter__(self):
+        return iter(self.metrics)
+
+    def __len__(self):
+        return len(self.metrics)
+
+
+class EvaluatedSuite(Suite):
+    """
+    A suite which has been evaluated with a language model.
+
+    Rather than copying the original suite, an evaluated suite shares its
+    item structure, and stores per-region metric values and OOVs in flat
+    sequences (one element per region, in suite order). Item dicts including
+    ``metric_value`` and ``oovs`` are built from these on first access to
+    :attr:`items`, and serialize just like the items of a deep-copied suite.
+
+    Prediction evaluation and :meth:`as_dataframe` read only the metrics
+    they need, so that with lazy :class:`RegionMetrics` values, metrics
+    which are never read are never computed.
+    """
+
+    def __init__(self, condition_names, region_names, base_items, predictions,
+                 meta, region_values: Mapping[str, Sequence[float]],
+                 region_oovs: Sequence[List[str]]):
+        """
+        Args:
+            base_items: Item dicts of the unevaluated suite. These are never
+                modified.
+            region_values: Maps each metric name to a sequence of per-region
+                metric values, e.g. a lazy :class:`RegionMetrics`.
+            region_oovs: Per-region lists of OOV spans.
+        """
+        self.base_items = base_items
+        self.region_values = region_values
+        self.region_oovs = region_oovs
+        self._items = None
+
+        n_regions = sum(len(cond["regions"]) for item in base_items
+                        for cond in item["conditions"])
+        if isinstance(region_values, RegionMetrics):
+            values_ok = region_values.n_regions == n_regions
+        else:
+            values_ok = all(len(values) == n_regions
+                            for values in region_values.values())
+        if len(region_oovs) != n_regions or not values_ok:
+            raise ValueError("Expected per-region data for %i regions" % n_regions)
+
+        super().__init__(condition_names=condition_names,
+                         region_names=region_names,
+                         items=None,
+                         predictions=predictions,
+                         meta=meta)
+
+    @classmethod
+    def from_suite(cls, suite: Suite, region_values: Mapping[str, Sequence[float]],
+                   region_oovs: Sequence[List[str]],
+                   meta: Optional[Dict[str, Any]] = None) -> EvaluatedSuite:
+        """
+        Create an evaluated suite sharing structure with ``suite``.
+        """
+        return cls(condition_names=suite.condition_names,
+                   region_names=suite.region_names,
+                   base_items=suite.items,
+                   predictions=suite.predictions,
+                   meta=meta if meta is not None else suite.meta,
+                   region_values=region_values,
+                   region_oovs=region_oovs)
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = self._build_items()
+        return self._items
+
+    @items.setter
+    def items(self, items):
+        self._items = items
+
+    def _build_items(self, metrics: Optional[Sequence[str]] = None,
+                     full: bool = True):
+        """
+        Build evaluated item dicts from the base items.
+
+        Args:
+            metrics: Metrics to include in each region's ``metric_value``.
+                Defaults to all metrics in :attr:`region_values`.
+            full: If ``False``, build minimal items which include only the
+                fields read by predictions.
+        """
+        if metrics is None:
+            metrics = list(self.region_values.keys())
+        values = [(metric, self.region_values[metric]) for metric in metrics]
+
+        # Copy only the containers along the path to each region; region
+        # content and other fields are shared with the base items.
+        region_idx = 0
+        items = []
+        for item in self.base_items:
+            conditions = []
+            for cond in item["conditions"]:
+                regions = []
+                for region in cond["regions"]:
+                    metric_value = {metric: metric_values[region_idx]
+                                    for metric, metric_values in values}
+                    if full:
+                        region = dict(region)
+                        region["metric_value"] = metric_value
+                        region["oovs"] = self.region_oovs[region_idx]
+                    else:
+                        region = {"region_number": region["region_number"],
+                                  "metric_value": metric_value}
+                    regions.append(region)
+                    region_idx += 1
+
+                if full:
+                    conditions.append(dict(cond, regions=regions))
+                else:
+                    conditions.append({"condition_name": cond["condition_name"],
+                                       "regions": regions})
+            items.append(dict(item, conditions=conditions) if full
+                         else {"item_number": item["item_number"],
+                               "conditions": conditions})
+
+        return items
+
+    def as_dataframe(self, metric: str = None) -> pd.DataFrame:
+        if self._items is not None:
+            return super().as_dataframe(metric)
+
+        columns = ("item_number", "condition_name", "region_number", "content",
+                   "metric_value", "oovs")
+        index_columns = ["item_number", "condition_name", "region_number"]
+        metric = metric or self.meta["metric"]
+        values = self.region_values[metric]
+
+        ret = []
+        region_idx = 0
+        for item in self.base_items:
+            for condition in item["conditions"]:
+                for region in condition["regions"]:
+                    ret.append((
+                        item["item_number"],
+                        condition["condition_name"],
+                        region["region_number"],
+                        region["content"],
+                        values[region_idx],
+                        ",".join(self.region_oovs[region_idx])
+                    ))
+                    region_idx += 1
+
+        return pd.DataFrame(ret, columns=columns).set_index(index_columns)
+
+    def _metric_matrix(self, metric: str) -> np.ndarray:
+        if self._items is not None:
+            return super()._metric_matrix(metric)
+
+        # Region values are already stored in item order.
+        return np.asarray(self.region_values[metric], dtype=float) \
+            .reshape(len(self.base_items), -1)
+
+    def evaluate_predictions(self) -> Dict[int, Dict[Prediction, bool]]:
+        if self._items is not None:
+            # Items may have been modified since they were built.
+            return super().evaluate_predictions()
+
+        result = self._evaluate_predictions_dense(self.base_items)
+        if result is not None:
+            return result
+
+        # Evaluate predictions on minimal items, carrying only the metrics
+        # referenced by predictions.
+        metrics = sorted({prediction.metric for prediction in self.predictions})
+        return self._evaluate_predictions_itemwise(
+            self._build_items(metrics, full=False))
+
+
 class Sentence(object):
     def __init__(self, tokens, unks=None, item_num=None,
                  condition_name='', regions=None):
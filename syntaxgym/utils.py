@@ -23,6 +23,80 @@ METRICS = {
     'min': min
 }
 
+
+def _segment_median(values, starts, lengths, seg_ids):
+    # Sort values within each segment, then read off the middle element(s).
+    sorted_values = values[np.lexsort((values, seg_ids))]
+    lo = sorted_values[starts + (lengths - 1) // 2]
+    hi = sorted_values[starts + lengths // 2]
+    ret = (lo + hi) / 2
+    # Follow np.median in propagating NaNs.
+    ret[np.add.reduceat(np.isnan(values), starts) > 0] = np.nan
+    return ret
+
+
+SEGMENT_METRICS = {
+    'sum': lambda values, starts, *_: np.add.reduceat(values, starts),
+    'mean': lambda values, starts, lengths, _: np.add.reduceat(values, starts) / lengths,
+    'median': _segment_median,
+    'range': lambda values, starts, *_: np.maximum.reduceat(values, starts)
+                                        - np.minimum.reduceat(values, starts),
+    'max': lambda values, starts, *_: np.maximum.reduceat(values, starts),
+    'min': lambda values, starts, *_: np.minimum.reduceat(values, starts),
+}
+"""
+Vectorized versions of :data:`METRICS`, which reduce many non-empty
+contiguous segments of a flat value array at once. Each is called as
+``fn(values, starts, lengths, seg_ids)``.
+
+Sums are accumulated in a different order than by :data:`METRICS` (e.g.
+``np.mean`` sums pairwise), so results may differ from them in the last bits.
+"""
+
+
+def aggregate_segments(values, lengths, metrics):
+    """
+    Compute metrics over consecutive segments of ``values`` in bulk.
+
+    Args:
+        values: Flat array of values, the concatenation of all segments.
+        lengths: Length of each segment. Segments may be empty.
+        metrics: Names of metrics in :data:`METRICS` to compute.
+
+    Returns:
+        A dict mapping each metric name to an array with one value per
+        segment. Empty segments have a sum of zero, and a value of NaN for
+        all other metrics. (Applying :data:`METRICS` to an empty segment
+        instead raises for ``max``, ``min`` and ``range``.)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    lengths = np.asarray(lengths, dtype=int)
+    if lengths.sum() != len(values):
+        raise ValueError("Segment lengths do not cover values array")
+
+    # reduceat can't express empty segments, so only reduce non-empty ones.
+    nonempty = lengths > 0
+    nonempty_lengths = lengths[nonempty]
+    starts = np.cumsum(nonempty_lengths) - nonempty_lengths
+    seg_ids = np.repeat(np.arange(len(nonempty_lengths)), nonempty_lengths)
+
+    ret = {}
+    for metric in metrics:
+        metric_values = np.full(len(lengths), 0.0 if metric == 'sum' else np.nan)
+        if nonempty.any():
+            if metric in SEGMENT_METRICS:
+                metric_values[nonempty] = SEGMENT_METRICS[metric](
+                    values, starts, nonempty_lengths, seg_ids)
+            else:
+                # Fall back to per-segment evaluation for custom metrics.
+                metric_values[nonempty] = [
+                    METRICS[metric](segment)
+                    for segment in np.split(values, starts[1:])]
+        ret[metric] = metric_values
+
+    return ret
+
+
 MODELS = ['grnn', 'transformer-xl', 'rnng', 'jrnn', 'ordered-neurons', 'roberta']
 
 class TokenMismatch(Exception):
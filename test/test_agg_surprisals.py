@@ -1,6 +1,8 @@
 from copy import deepcopy
 from io import StringIO
 import itertools
+import json
+from pathlib import Path
 from pprint import pprint
 
 import pytest
@@ -10,9 +12,11 @@ import pandas as pd
 import lm_zoo as Z
 
 from syntaxgym import aggregate_surprisals
-from syntaxgym.agg_surprisals import compute_mapping_heuristic, compute_mapping_huggingface
+from syntaxgym.agg_surprisals import compute_mapping_heuristic, compute_mapping_huggingface, \
+    compute_mappings_huggingface, find_token_mismatches, prepare_sentences_huggingface, \
+    TokenizerProfile, _ContentIndex
 from syntaxgym.suite import Suite, Region
-from syntaxgym.utils import TokenMismatch, METRICS
+from syntaxgym.utils import TokenMismatch, METRICS, aggregate_segments
 
 from conftest import with_images
 
@@ -193,6 +197,37 @@ def test_basic(suite, metric):
                                    metric_fn(surprisals.iloc[:3].surprisal))
 
 
+@pytest.mark.parametrize("metric", list(METRICS.keys()))
+def test_aggregate_segments(metric):
+    rng = np.random.RandomState(0)
+    lengths = np.array([3, 0, 1, 4, 0, 2, 5])
+    values = rng.randn(lengths.sum())
+
+    result = aggregate_segments(values, lengths, [metric])[metric]
+
+    segments = np.split(values, np.cumsum(lengths)[:-1])
+    expected = [METRICS[metric](segment) if len(segment) else np.nan
+                for segment in segments]
+    if metric == "sum":
+        expected = [value if not np.isnan(value) else 0. for value in expected]
+    np.testing.assert_allclose(result, expected)
+
+
+def test_find_token_mismatches():
+    tokens = [["a", "b"], ["c"], ["d", "e"], ["f"]]
+    surp_tokens = np.array(["a", "b", "c", "x", "d", "e", "f", "g"], dtype=object)
+    offsets = np.array([0, 2, 4, 6, 8])
+
+    # Sentence 2 is too long, sentence 4 too short; the rest match.
+    np.testing.assert_array_equal(
+        find_token_mismatches(tokens, surp_tokens, offsets), [1, 3])
+
+    surp_tokens = np.array(["a", "x", "c", "d", "e", "f"], dtype=object)
+    offsets = np.array([0, 2, 3, 5, 6])
+    np.testing.assert_array_equal(
+        find_token_mismatches(tokens, surp_tokens, offsets), [0])
+
+
 def test_tokenization_too_short(suite):
     """
     throw error when tokens list missing tokens from surprisals list
@@ -597,6 +632,147 @@ def test_dynamic_case(registry, client, description, image, regions, tokens,
         assert mapping.oovs == expected_oovs
 
 
+def _load_dummy_image_spec(image):
+    image_dir = image.replace("lmzoo-", "").replace("-", "_")
+    with (Path(__file__).parent / "dummy_images" / image_dir / "spec.json").open() as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize(argnames=("description", "image", "regions", "tokens",
+                                   "expected_region2tokens", "expected_oovs"),
+                         argvalues=DYNAMIC_CASES,
+                         ids=[x[0] for x in DYNAMIC_CASES])
+def test_dynamic_case_profile(description, image, regions, tokens,
+                              expected_region2tokens, expected_oovs):
+    """
+    Run dynamic test cases offline against a precomputed tokenizer profile,
+    using the expected tokenization where none is given.
+    """
+    regions = [Region(region_number=i + 1, content=region)
+               for i, region in enumerate(regions)]
+    if tokens is None:
+        tokens = [token for region_tokens in expected_region2tokens.values()
+                  for token in region_tokens]
+
+    profile = TokenizerProfile.from_spec(_load_dummy_image_spec(image))
+    mapping = compute_mapping_heuristic(tokens, regions, profile)
+
+    assert mapping.region_to_tokens == expected_region2tokens
+    assert mapping.oovs == expected_oovs
+
+
+@pytest.mark.parametrize("regions,tokens,expected_region2tokens,expected_oovs", [
+    (["the cat", "sat on", "the mat"], ["the", "<unk>", "<unk>", "on", "the", "mat"],
+     {1: ["the", "<unk>", "<unk>"], 2: ["on"], 3: ["the", "mat"]},
+     {1: ["cat", "sat"], 2: [], 3: []}),
+    (["abc def", "g", "def"], ["<unk>", "def", "g", "def"],
+     {1: ["<unk>", "def"], 2: ["g"], 3: ["def"]},
+     {1: ["abc"], 2: [], 3: []}),
+])
+def test_oov_resolution(regions, tokens, expected_region2tokens, expected_oovs):
+    regions = [Region(region_number=i + 1, content=region)
+               for i, region in enumerate(regions)]
+    with open(Path(__file__).parent / "dummy_specs" / "basic.json") as f:
+        spec = json.load(f)
+
+    mapping = compute_mapping_heuristic(tokens, regions, spec)
+    assert mapping.region_to_tokens == expected_region2tokens
+    assert mapping.oovs == expected_oovs
+
+
+def test_content_index():
+    index = _ContentIndex(["remand and", "", "xand ,"])
+    # Word-like tokens only match at word boundaries.
+    assert index.find("and") == (0, 7)
+    assert index.find("and", start_segment=1) is None
+    assert index.find(",") == (2, 5)
+    assert index.find("nd") is None
+    assert index.find("xand") == (2, 0)
+
+
+def test_compute_mappings_huggingface():
+    # Sentence 1: "The cat sat" with regions "The cat" / "sat", and special
+    # tokens with empty offsets at both ends.
+    # Sentence 2: "" / "A dog" / "" / "ran", with a subword split.
+    regions = [
+        [Region(region_number=1, content="The cat"), Region(region_number=2, content="sat")],
+        [Region(region_number=1, content=""), Region(region_number=2, content="A dog"),
+         Region(region_number=3, content=""), Region(region_number=4, content="ran")],
+    ]
+    tokens = [["<s>", "The", "cat", "sat", "</s>"], ["A", "d", "og", "ran"]]
+    token_offsets = [[(0, 0), (0, 3), (4, 7), (8, 11), (0, 0)],
+                     [(0, 1), (2, 3), (3, 5), (6, 9)]]
+    region_edges = [[0, 8], [0, 0, 5, 6]]
+
+    mappings = compute_mappings_huggingface(tokens, regions, token_offsets,
+                                            region_edges, [(1, "a"), (1, "b")])
+    assert [mapping.region_to_tokens for mapping in mappings] == [
+        {1: ["<s>", "The", "cat"], 2: ["sat", "</s>"]},
+        {1: [], 2: ["A", "d", "og"], 3: [], 4: ["ran"]},
+    ]
+    assert mappings[1].id == (1, "b")
+
+    # Single-sentence API agrees.
+    assert compute_mapping_huggingface(tokens[1], regions[1], token_offsets[1],
+                                       region_edges[1], 1, "b") == mappings[1]
+
+
+class WhitespaceOffsetTokenizer(object):
+    """
+    Fake Huggingface tokenizer splitting on whitespace, which records the
+    sentences it encodes.
+    """
+
+    def __init__(self):
+        self.encoded = []
+
+    def batch_encode_plus(self, sentences, add_special_tokens=True,
+                          return_offsets_mapping=True):
+        self.encoded.extend(sentences)
+        all_tokens, all_offsets = [], []
+        for sentence in sentences:
+            tokens, offsets, start = [], [], 0
+            for token in sentence.split(" "):
+                tokens.append(token)
+                offsets.append((start, start + len(token)))
+                start += len(token) + 1
+            all_tokens.append(tokens)
+            all_offsets.append(offsets)
+
+        class Encoding(dict):
+            def tokens(self, idx):
+                return all_tokens[idx]
+
+        return Encoding(offset_mapping=all_offsets)
+
+
+def test_prepare_sentences_huggingface(dummy_suite_json):
+    suite_json = deepcopy(dummy_suite_json)
+    # Duplicate the item, so each sentence appears twice.
+    item = deepcopy(suite_json["items"][0])
+    item["item_number"] = 2
+    suite_json["items"].append(item)
+    suite = Suite.from_dict(suite_json)
+
+    class OffsetModel(object):
+        provides_token_offsets = True
+        tokenizer = WhitespaceOffsetTokenizer()
+
+    model = OffsetModel()
+    mappings = prepare_sentences_huggingface(model, None, suite)
+
+    sentences = list(suite.iter_sentences())
+    assert len(model.tokenizer.encoded) == len(set(sentences)) < len(sentences)
+
+    assert len(mappings) == len(sentences)
+    for mapping, item_number in zip(mappings, [1] * 4 + [2] * 4):
+        assert mapping.id[0] == item_number
+    for cond, mapping in zip(suite.items[0]["conditions"], mappings):
+        assert mapping.region_to_tokens == {
+            region["region_number"]: region["content"].split()
+            for region in cond["regions"]}
+
+
 DYNAMIC_CASES_HUGGINGFACE = [
 
     ("reformer",
@@ -0,0 +1,155 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from types import SimpleNamespace
+
+from docker.errors import ImageNotFound
+from lm_zoo.models import DockerModel, HuggingFaceModel, SingularityModel
+import numpy as np
+import pytest
+
+from syntaxgym import utils
+from syntaxgym.cache import AlignmentCache, CachedSentence, SurprisalCache, \
+    _hash_path, _model_identity
+
+
+def _entry(sentence):
+    tokens = sentence.split(" ")
+    return CachedSentence(tokens, tokens, np.arange(len(tokens), dtype=np.float64))
+
+
+def test_roundtrip(tmp_path):
+    cache = SurprisalCache(tmp_path / "cache.sqlite")
+    cache.put_many("model", {"a b": _entry("a b"), "c": _entry("c")})
+
+    hits = cache.get_many("model", ["a b", "c", "d"])
+    assert set(hits.keys()) == {"a b", "c"}
+    assert hits["a b"].tokens == ["a", "b"]
+    np.testing.assert_array_equal(hits["a b"].surprisals, [0, 1])
+
+    assert cache.get_many("other_model", ["a b"]) == {}
+
+    # Cache should persist across instances.
+    cache.close()
+    assert len(SurprisalCache(tmp_path / "cache.sqlite")) == 2
+
+
+def _put_entries(path, worker, n=50):
+    cache = SurprisalCache(path)
+    for i in range(n):
+        sentence = "w%i s%i" % (worker, i)
+        cache.put_many("model", {sentence: _entry(sentence)})
+
+
+def test_concurrent_writers(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(_put_entries, path, worker)
+                   for worker in range(4)]
+        for future in futures:
+            future.result()
+
+    assert len(SurprisalCache(path)) == 4 * 50
+
+
+def test_mismatched_surprisal_tokens(tmp_path):
+    cache = SurprisalCache(tmp_path / "cache.sqlite")
+    entry = CachedSentence(["a", "b"], ["a", "c"], np.zeros(2))
+    cache.put_many("model", {"a b": entry})
+
+    assert cache.get_many("model", ["a b"])["a b"].surprisal_tokens == ["a", "c"]
+
+
+def test_lru_eviction(tmp_path):
+    cache = SurprisalCache(tmp_path / "cache.sqlite")
+    cache.put_many("model", {"a": _entry("a")})
+    cache.put_many("model", {"b": _entry("b")})
+    # Touch "a" so that "b" is least recently used.
+    cache.get_many("model", ["a"])
+
+    cache.max_size = 2 * (len("c") + len('["c"]') + 8)
+    cache.put_many("model", {"c": _entry("c")})
+
+    assert set(cache.get_many("model", ["a", "b", "c"]).keys()) == {"a", "c"}
+
+
+def test_alignment_roundtrip(tmp_path):
+    cache = AlignmentCache(tmp_path / "alignments.sqlite")
+    tokens = [["a", "b"], ["c"]]
+    cache.put("key", tokens, [[[1, "x"], [[1, [0, 1]]], []]])
+
+    assert cache.get("key", tokens) == [[[1, "x"], [[1, [0, 1]]], []]]
+    assert cache.get("other_key", tokens) is None
+    # Entries computed from different tokens are not reused.
+    assert cache.get("key", [["a", "b"], ["d"]]) is None
+
+
+def test_hash_path(tmp_path):
+    with pytest.raises(ValueError):
+        _hash_path(tmp_path / "missing")
+
+    checkpoint = tmp_path / "checkpoint"
+    checkpoint.mkdir()
+    weights = checkpoint / "weights.bin"
+    weights.write_bytes(b"abcd")
+    key = _hash_path(checkpoint)
+    assert _hash_path(str(checkpoint) + "/") == key
+
+    # Same size and modification time, different content.
+    stat = weights.stat()
+    weights.write_bytes(b"abce")
+    os.utime(weights, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert _hash_path(checkpoint) != key
+
+    # Same content at a different location.
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "weights.bin").write_bytes(b"abce")
+    assert _hash_path(other) != _hash_path(checkpoint)
+
+
+def _huggingface_model(model_ref, commit_hash=None):
+    model = object.__new__(HuggingFaceModel)
+    model.model_ref = model_ref
+    model._config = SimpleNamespace(_commit_hash=commit_hash)
+    return model
+
+
+def test_huggingface_model_identity(tmp_path):
+    assert _model_identity(_huggingface_model("gpt2", "abc")) \
+        != _model_identity(_huggingface_model("gpt2", "def"))
+    with pytest.raises(ValueError):
+        _model_identity(_huggingface_model("gpt2"))
+
+    # Local model directories are fingerprinted by content.
+    (tmp_path / "config.json").write_text("{}")
+    identity = _model_identity(_huggingface_model(str(tmp_path)))
+    (tmp_path / "config.json").write_text("{\"n_layer\": 2}")
+    assert _model_identity(_huggingface_model(str(tmp_path))) != identity
+
+
+def test_docker_model_identity(tmp_path, monkeypatch):
+    images = {"lmzoo/gpt2:latest": SimpleNamespace(id="sha256:abc")}
+    def get_image(name):
+        if name not in images:
+            raise ImageNotFound(name)
+        return images[name]
+    client = SimpleNamespace(images=SimpleNamespace(get=get_image))
+    monkeypatch.setattr(utils, "_get_docker_client", lambda: client)
+
+    assert _model_identity(DockerModel("lmzoo/gpt2"))["image_id"] == "sha256:abc"
+
+    # Images which haven't been pulled can't be identified...
+    with pytest.raises(ValueError):
+        _model_identity(DockerModel("lmzoo/unpulled"))
+    # ... unless a custom checkpoint identifies the weights.
+    (tmp_path / "weights.bin").write_bytes(b"abcd")
+    _model_identity(DockerModel("lmzoo/unpulled").with_checkpoint(str(tmp_path)))
+
+
+def test_singularity_model_identity(tmp_path):
+    model = SingularityModel("library", "lmzoo/gpt2")
+    with pytest.raises(ValueError):
+        _model_identity(model)
+
+    (tmp_path / "weights.bin").write_bytes(b"abcd")
+    assert "checkpoint" in _model_identity(model.with_checkpoint(str(tmp_path)))
@@ -1,3 +1,8 @@
+from pathlib import Path
+import pickle
+import subprocess
+import sys
+
 import pytest
 
 from copy import deepcopy
@@ -77,3 +82,94 @@ def test_asterisk(dummy_suite_json):
 def test_invalid_metric():
     with pytest.raises(ValueError):
         Prediction(0, "%1;abc%>%1;xyz%", "foo")
+
+
+@pytest.mark.parametrize("formula", [
+    "5 - 4 - 3 < 0",
+    "(5;%sub_no-matrix%)>(5;%no-sub_no-matrix%)",
+    "((5;%sub_no-matrix%) - (5;%no-sub_no-matrix%)) = ((1;%sub_no-matrix%) - (1;%no-sub_no-matrix%))",
+    "((5;%sub_no-matrix%) > 0) | ((*;%sub_no-matrix%) < (*;%no-sub_no-matrix%))",
+    "((5;%sub_no-matrix%) < 0) & ((*;%sub_no-matrix%) > 1)",
+])
+def test_compiled_formula(dummy_suite_json, formula):
+    p = Prediction(0, formula, "sum")
+    item = dummy_suite_json["items"][0]
+    surps = {(c["condition_name"], r["region_number"]): r["metric_value"]["sum"]
+             for c in item["conditions"] for r in c["regions"]}
+
+    compiled = p.formula.compile()
+    assert compiled(surps) == p.formula(surps)
+    assert p(item) == p.formula(surps)
+
+    # Compiled formulas are dropped on pickling and rebuilt on demand.
+    assert pickle.loads(pickle.dumps(p))(item) == p(item)
+
+
+def test_prediction_declared_metric():
+    p0 = Prediction.from_dict({"type": "formula", "formula": "1 > 0"}, 0, "sum")
+    assert p0.metric == "sum"
+    assert "metric" not in p0.as_dict()
+
+    p1 = Prediction.from_dict({"type": "formula", "formula": "1 > 0", "metric": "mean"},
+                              1, "sum")
+    assert p1.metric == "mean"
+    assert p1.as_dict()["metric"] == "mean"
+
+
+def _same_tree(a, b):
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, Region):
+        return (a.region_number, a.condition_name) == (b.region_number, b.condition_name)
+    if isinstance(a, LiteralFloat):
+        return a.value == b.value
+    return a.operator == b.operator and \
+        all(_same_tree(x, y) for x, y in zip(a.operands, b.operands))
+
+
+@pytest.mark.parametrize("formula", [
+    "5 - 4 - 3 < 0",
+    "5+4=9-1+1",
+    "5 - -4 > +3",
+    "-2.5E-2 < .5 & 1e3 > 5.",
+    "(5;%sub_no-matrix%)>(5;%no-sub_no-matrix%)",
+    "( 5 ;% a %) - (*;%b%)",
+    "(((1;%a%)))",
+    "(5-3)+((2+1)-(2+2))=1",
+    # Only the first comparison of a comparison chain is kept.
+    "1 < 2 < 0",
+    "(1;%a%) < (2;%a%) | (1;%b%) = (2;%b%) & (3;%a%) > 0",
+    "\t(007;%a%)\n> 1 ",
+])
+def test_fast_parser(formula):
+    fast = parse_formula(formula)
+    assert _same_tree(fast, get_prediction_grammar().parseString(formula, parseAll=True)[0])
+    assert str(fast) == str(parse_formula(formula, fast=False))
+
+
+@pytest.mark.parametrize("formula", ["", "5 <", "(5;%a%", "(5;%a b%) > 1", "5 <= 4"])
+def test_parse_invalid_formula(formula):
+    with pytest.raises(ValueError):
+        parse_formula(formula)
+
+
+def test_parsed_formulas_shared():
+    p0 = Prediction(0, "(1;%a%) > (1;%b%)", "sum")
+    p1 = Prediction(1, "(1;%a%) > (1;%b%)", "sum")
+    assert p0.formula is p1.formula
+    assert p0 != p1
+    assert len({p0, p1}) == 2
+
+
+def test_lazy_grammar():
+    """
+    Importing syntaxgym, and parsing well-formed formulas, shouldn't import
+    pyparsing or build the formula grammar.
+    """
+    code = ("import sys, syntaxgym.prediction as P; "
+            "P.Prediction(0, '(1;%a%) > 0', 'sum'); "
+            "assert 'pyparsing' not in sys.modules; "
+            "P.get_prediction_grammar(); "
+            "assert 'pyparsing' in sys.modules")
+    subprocess.run([sys.executable, "-c", code], check=True,
+                   cwd=Path(__file__).parent.parent)
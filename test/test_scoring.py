@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+from syntaxgym.scoring import deduplicate_sentences, expand_surprisals, \
+    slice_surprisals, tokens_from_surprisals
+
+
+def _make_surprisals(sentences):
+    df = [(i + 1, j + 1, token, float(len(token)))
+          for i, sentence in enumerate(sentences)
+          for j, token in enumerate(sentence.split(" "))]
+    return pd.DataFrame(df, columns=["sentence_id", "token_id", "token", "surprisal"]) \
+        .set_index(["sentence_id", "token_id"])
+
+
+def test_deduplicate_sentences():
+    sentences = ["a b", "c", "a b", "d e f", "c"]
+    unique, inverse = deduplicate_sentences(sentences)
+
+    assert unique == ["a b", "c", "d e f"]
+    assert [unique[i] for i in inverse] == sentences
+
+
+def test_expand_surprisals():
+    sentences = ["a b", "c", "a b", "d e f", "c", "c"]
+    unique, inverse = deduplicate_sentences(sentences)
+
+    expanded = expand_surprisals(_make_surprisals(unique), inverse)
+    pd.testing.assert_frame_equal(expanded, _make_surprisals(sentences))
+
+
+def test_slice_surprisals():
+    sentences = ["a b", "c", "d e f", "g h"]
+    surprisals = _make_surprisals(sentences)
+
+    pd.testing.assert_frame_equal(slice_surprisals(surprisals, 1, 2),
+                                  _make_surprisals(sentences[1:3]))
+
+
+def test_tokens_from_surprisals():
+    sentences = ["a b", "c", "d e f"]
+    assert tokens_from_surprisals(_make_surprisals(sentences), 3) == \
+        [sentence.split(" ") for sentence in sentences]
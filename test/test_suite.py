@@ -8,6 +8,7 @@ import sys
 from tempfile import NamedTemporaryFile
 
 import jsonschema
+import numpy as np
 import pandas as pd
 import pytest
 import requests
@@ -18,6 +19,8 @@ L = logging.getLogger(__name__)
 
 import lm_zoo as Z
 
+import syntaxgym.suite
+from syntaxgym.prediction import Prediction, surprisal_lookup
 from syntaxgym.suite import Suite, Sentence, Region
 
 from conftest import LM_ZOO_IMAGES, with_images
@@ -68,3 +71,71 @@ def test_suite_as_dataframe(dummy_suite_json, dummy_suite_csv):
         .set_index(df.index.names)
 
     pd.testing.assert_frame_equal(df, expected_df)
+
+
+def _random_suite(dummy_suite_json, n_items, seed=0):
+    rng = np.random.RandomState(seed)
+    suite_json = deepcopy(dummy_suite_json)
+    item = suite_json["items"][0]
+    suite_json["items"] = []
+    for i in range(n_items):
+        item_i = deepcopy(item)
+        item_i["item_number"] = i + 1
+        for cond in item_i["conditions"]:
+            for region in cond["regions"]:
+                # Include exact ties, so that `=` comparisons are exercised.
+                region["metric_value"]["sum"] = float(rng.randint(0, 4))
+        suite_json["items"].append(item_i)
+
+    suite_json["predictions"] += [
+        {"type": "formula", "formula": "(*;%sub_no-matrix%) > (*;%no-sub_no-matrix%)"},
+        {"type": "formula", "formula": "((1;%sub_matrix%) = (1;%no-sub_matrix%)) | (2 - 1 > 3)"},
+        {"type": "formula", "formula": "(1;%sub_matrix%) - (2;%sub_matrix%) + 1"},
+        {"type": "formula", "formula": "5 - 4 - 3 < 0"},
+    ]
+    return Suite.from_dict(suite_json)
+
+
+def _evaluate_itemwise(suite):
+    return {item["item_number"]: {prediction: prediction(item)
+                                  for prediction in suite.predictions}
+            for item in suite.items}
+
+
+def test_evaluate_predictions_dense(dummy_suite_json):
+    suite = _random_suite(dummy_suite_json, 50)
+    assert suite._evaluate_predictions_dense(suite.items) is not None
+    assert suite.evaluate_predictions() == _evaluate_itemwise(suite)
+
+
+def test_evaluate_predictions_nonuniform(dummy_suite_json):
+    suite = _random_suite(dummy_suite_json, 5)
+    del suite.items[2]["conditions"][1]["regions"][0]
+    assert suite._evaluate_predictions_dense(suite.items) is None
+    assert suite.evaluate_predictions() == _evaluate_itemwise(suite)
+
+
+def test_evaluate_predictions_shared_lookup(dummy_suite_json, monkeypatch):
+    suite = _random_suite(dummy_suite_json, 5)
+    for item in suite.items:
+        for cond in item["conditions"]:
+            for region in cond["regions"]:
+                region["metric_value"]["mean"] = region["metric_value"]["sum"] / 2
+    suite.predictions.append(Prediction.from_dict(
+        {"type": "formula", "formula": "(1;%sub_matrix%) < 1", "metric": "mean"},
+        len(suite.predictions), "sum"))
+    expected = _evaluate_itemwise(suite)
+
+    # Force item-by-item evaluation.
+    del suite.items[2]["conditions"][1]["regions"][0]
+    expected[3] = {prediction: prediction(suite.items[2])
+                   for prediction in suite.predictions}
+
+    calls = []
+    def lookup(item, metric):
+        calls.append(metric)
+        return surprisal_lookup(item, metric)
+    monkeypatch.setattr(syntaxgym.suite, "surprisal_lookup", lookup)
+
+    assert suite.evaluate_predictions() == expected
+    assert sorted(calls) == ["mean"] * 5 + ["sum"] * 5
@@ -0,0 +1,541 @@
+"""
+Tests for the top-level ``syntaxgym`` API.
+"""
+
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import json
+from pathlib import Path
+import subprocess
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+
+import lm_zoo as Z
+
+import syntaxgym as S
+from syntaxgym.agg_surprisals import ItemSentenceMapping
+from syntaxgym.cache import AlignmentCache, SurprisalCache
+from syntaxgym import commands
+from syntaxgym import utils
+from syntaxgym.scoring import score_sentences
+from syntaxgym.sidecar import Sidecar
+from syntaxgym.suite import EvaluatedSuite, RegionMetrics, Suite
+
+
+spec = {
+    "name": "lmzoo-whitespace",
+    "ref_url": "",
+    "image": {},
+    "vocabulary": {
+        "unk_types": ["<unk>"],
+        "prefix_types": [],
+        "suffix_types": ["<eos>"],
+        "special_types": [],
+        "items": [],
+    },
+    "tokenizer": {
+        "type": "word",
+        "cased": True,
+    },
+}
+
+
+class WhitespaceModel(Z.models.DummyModel):
+    """
+    Dummy model which responds to arbitrary sentences. Sentences are tokenized
+    on whitespace, and each token is assigned a surprisal equal to its length.
+    Tracks the number of calls made to each LM Zoo command.
+    """
+
+    def __init__(self):
+        # Model outputs are defined by this module, so fingerprint it for
+        # the surprisal cache.
+        self.reference = Path(__file__)
+        self.calls = Counter()
+        self.sentences = []
+
+    def get_result(self, command, sentences=None):
+        self.calls[command] += 1
+        if command == "spec":
+            return spec
+
+        self.sentences.append(list(sentences))
+        tokens = [sentence.split(" ") + ["<eos>"] for sentence in sentences]
+        if command == "tokenize":
+            return tokens
+        elif command == "get_surprisals":
+            df = [(i + 1, j + 1, token, float(len(token)))
+                  for i, sent_tokens in enumerate(tokens)
+                  for j, token in enumerate(sent_tokens)]
+            return pd.DataFrame(df, columns=["sentence_id", "token_id", "token", "surprisal"]) \
+                .set_index(["sentence_id", "token_id"])
+
+        raise NotImplementedError(command)
+
+
+def _make_suite_json(dummy_suite_json, n_items=2, name="dummy"):
+    suite_json = deepcopy(dummy_suite_json)
+    suite_json["meta"]["name"] = name
+
+    item = suite_json["items"][0]
+    suite_json["items"] = []
+    for i in range(n_items):
+        item_i = deepcopy(item)
+        item_i["item_number"] = i + 1
+        for cond in item_i["conditions"]:
+            cond["regions"][2]["content"] = "shot the bird%s" % ("s" * i)
+        suite_json["items"].append(item_i)
+
+    return suite_json
+
+
+@pytest.fixture
+def model():
+    return WhitespaceModel()
+
+
+def _region_values(suite, metric="sum"):
+    return [region["metric_value"][metric]
+            for item in suite.items
+            for cond in item["conditions"]
+            for region in cond["regions"]]
+
+
+def test_compute_surprisals(model, dummy_suite_json):
+    suite = S.compute_surprisals(model, _make_suite_json(dummy_suite_json))
+
+    region = suite.items[0]["conditions"][0]["regions"][0]
+    assert region["content"] == "After the man"
+    assert region["metric_value"]["sum"] == len("After") + len("the") + len("man")
+
+    # Final region includes end-of-sentence token.
+    region = suite.items[0]["conditions"][0]["regions"][-1]
+    assert region["metric_value"]["sum"] == len(".") + len("<eos>")
+
+    assert suite.meta["model"] == spec["name"]
+
+
+def test_aggregate_surprisals_checks_all_sentences(model, dummy_suite_json):
+    suite = Suite.from_dict(_make_suite_json(dummy_suite_json))
+    surprisals, tokens = score_sentences(model, list(suite.iter_sentences()))
+
+    # Drop a token from the last sentence only.
+    tokens[-1] = tokens[-1][:-1]
+    with pytest.raises(ValueError):
+        S.aggregate_surprisals(model, surprisals, tokens, suite)
+
+
+@pytest.mark.parametrize("metric", list(utils.METRICS.keys()))
+def test_compute_surprisals_empty_region(dummy_suite_json, metric):
+    suite_json = _make_suite_json(dummy_suite_json, n_items=1)
+    suite_json["meta"]["metric"] = metric
+    for cond in suite_json["items"][0]["conditions"]:
+        cond["regions"][3]["content"] = ""
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        result = S.compute_surprisals(WhitespaceModel(), suite_json)
+
+    region = result.items[0]["conditions"][0]["regions"][3]
+    if metric == "sum":
+        assert region["metric_value"][metric] == 0
+    else:
+        assert np.isnan(region["metric_value"][metric])
+    # Surrounding regions are unaffected.
+    assert result.items[0]["conditions"][0]["regions"][2]["metric_value"][metric] \
+        == pytest.approx(utils.METRICS[metric]([4., 3., 4.]))
+
+
+def test_compute_surprisals_parallel_alignment(model, dummy_suite_json, monkeypatch):
+    suite_json = _make_suite_json(dummy_suite_json, n_items=5)
+    expected = S.compute_surprisals(WhitespaceModel(), suite_json)
+
+    monkeypatch.setattr(S.agg_surprisals, "PARALLEL_ALIGNMENT_THRESHOLD", 1)
+    assert S.compute_surprisals(model, suite_json, alignment_workers=2) \
+        == expected
+
+
+def test_evaluated_suite_shares_structure(model, dummy_suite_json):
+    suite = Suite.from_dict(_make_suite_json(dummy_suite_json))
+    result = S.compute_surprisals(model, suite)
+    assert isinstance(result, EvaluatedSuite)
+    assert result.base_items is suite.items
+
+    # Serializes just like an updated deep copy of the original suite.
+    expected = deepcopy(suite.as_dict())
+    regions = [region for item in expected["items"]
+               for cond in item["conditions"] for region in cond["regions"]]
+    for i, region in enumerate(regions):
+        region["metric_value"] = {metric: values[i] for metric, values
+                                  in result.region_values.items()}
+        region["oovs"] = result.region_oovs[i]
+    expected["meta"]["model"] = spec["name"]
+
+    assert json.dumps(result.as_dict()) == json.dumps(expected)
+    assert "model" not in suite.meta
+
+
+def test_evaluated_suite_lazy_metrics(model, dummy_suite_json):
+    suite = Suite.from_dict(_make_suite_json(dummy_suite_json, n_items=2))
+    suite.meta = dict(suite.meta, metric="all")
+    result = S.compute_surprisals(model, suite)
+    assert isinstance(result.region_values, RegionMetrics)
+    assert result.region_values._values == {}
+
+    # Only the metrics which are read are computed.
+    predictions = result.evaluate_predictions()
+    assert set(result.region_values._values) == {"sum"}
+    df = result.as_dataframe("mean")
+    assert set(result.region_values._values) == {"sum", "mean"}
+    assert result._items is None
+
+    # Results match those computed from fully built items.
+    expected = Suite(condition_names=result.condition_names,
+                     region_names=result.region_names,
+                     items=deepcopy(result.items),
+                     predictions=result.predictions,
+                     meta=result.meta)
+    assert set(result.region_values._values) == set(utils.METRICS)
+    assert predictions == expected.evaluate_predictions()
+    pd.testing.assert_frame_equal(df, expected.as_dataframe("mean"))
+
+
+def test_compute_surprisals_many(model, dummy_suite_json):
+    suites = [_make_suite_json(dummy_suite_json, n_items=n, name="suite%i" % n)
+              for n in (1, 3, 2)]
+    results = S.compute_surprisals_many(model, suites)
+
+    assert model.calls["get_surprisals"] == 1
+    assert model.calls["tokenize"] == 1
+
+    assert [len(result.items) for result in results] == [1, 3, 2]
+    for suite_json, result in zip(suites, results):
+        expected = S.compute_surprisals(WhitespaceModel(), suite_json)
+        assert result == expected
+
+
+@pytest.mark.parametrize("dedup", [True, False])
+def test_compute_surprisals_dedup(model, dummy_suite_json, dedup):
+    suite_json = _make_suite_json(dummy_suite_json, n_items=2)
+    results = S.compute_surprisals_many(model, [suite_json, suite_json], dedup=dedup)
+
+    sent_sentences = model.sentences[0]
+    n_sentences = len(list(Suite.from_dict(suite_json).iter_sentences()))
+    if dedup:
+        assert len(sent_sentences) == n_sentences
+        assert len(set(sent_sentences)) == len(sent_sentences)
+    else:
+        assert len(sent_sentences) == 2 * n_sentences
+
+    expected = S.compute_surprisals(WhitespaceModel(), suite_json, dedup=False)
+    assert results[0] == expected
+    assert results[1] == expected
+
+
+def test_compute_surprisals_cache(model, dummy_suite_json, tmp_path):
+    cache = SurprisalCache(tmp_path / "cache.sqlite")
+
+    suite_json = _make_suite_json(dummy_suite_json, n_items=1)
+    S.compute_surprisals(model, suite_json, cache=cache)
+    n_sentences = len(model.sentences[0])
+
+    # Add an item and re-run. Only the new item's sentences should be scored.
+    model = WhitespaceModel()
+    bigger_suite_json = _make_suite_json(dummy_suite_json, n_items=2)
+    result = S.compute_surprisals(model, bigger_suite_json, cache=cache)
+
+    assert len(model.sentences[0]) == n_sentences
+    assert all("birds" in sentence for sentence in model.sentences[0])
+
+    assert result == S.compute_surprisals(WhitespaceModel(), bigger_suite_json)
+
+
+def test_compute_surprisals_cache_missing_checkpoint(dummy_suite_json, tmp_path):
+    cache = SurprisalCache(tmp_path / "cache.sqlite")
+    suite_json = _make_suite_json(dummy_suite_json, n_items=1)
+
+    # Models with unidentifiable weights are scored without the cache.
+    model = WhitespaceModel().with_checkpoint(str(tmp_path / "missing"))
+    result = S.compute_surprisals(model, suite_json, cache=cache)
+    assert len(cache) == 0
+    assert result == S.compute_surprisals(WhitespaceModel(), suite_json)
+
+
+def test_compute_surprisals_alignment_cache(dummy_suite_json, tmp_path, monkeypatch):
+    cache = AlignmentCache(tmp_path / "alignments.sqlite")
+    suite_json = _make_suite_json(dummy_suite_json)
+    expected = S.compute_surprisals(WhitespaceModel(), suite_json,
+                                    alignment_cache=cache)
+    assert len(cache) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("alignments should be read from the cache")
+    monkeypatch.setattr(S.agg_surprisals, "prepare_sentences", fail)
+
+    result = S.compute_surprisals(WhitespaceModel(), suite_json,
+                                  alignment_cache=cache)
+    assert result == expected
+
+
+def test_reaggregate(model, dummy_suite_json, tmp_path):
+    suite_json = _make_suite_json(dummy_suite_json)
+    sidecar = tmp_path / "surprisals.npz"
+    expected = S.compute_surprisals(model, suite_json, sidecar=sidecar)
+    assert S.reaggregate(suite_json, sidecar) == expected
+
+    # Move a word across a region boundary. Stored tokens are re-aligned
+    # without running the model.
+    suite_json = deepcopy(suite_json)
+    for item in suite_json["items"]:
+        for cond in item["conditions"]:
+            regions = cond["regions"]
+            if regions[0]["content"] == "After the man" and regions[1]["content"]:
+                regions[0]["content"] = "After the"
+                regions[1]["content"] = "man " + regions[1]["content"]
+
+    calls = dict(model.calls)
+    result = S.reaggregate(suite_json, Sidecar.load(sidecar))
+    assert model.calls == calls
+    assert result != expected
+    assert result == S.compute_surprisals(WhitespaceModel(), suite_json)
+
+    # Sentences must be unchanged.
+    suite_json["items"][0]["conditions"][0]["regions"][0]["content"] = "Before the"
+    with pytest.raises(ValueError):
+        S.reaggregate(suite_json, sidecar)
+
+
+def test_sidecar_select_sentences():
+    sidecar = Sidecar(spec=spec, sentences=["a b", "c", "a b"],
+                      tokens=np.array(["a", "b", "c", "a", "b"]),
+                      surprisals=np.arange(5.0), offsets=np.array([0, 2, 3, 5]),
+                      suite_fingerprint="", region_starts=np.array([0, 2, 3]),
+                      region_lengths=np.array([2, 1, 1]), region_oovs=[[], [], []])
+    tokens, surprisals, offsets = sidecar.select_sentences(["c", "a b"])
+    assert tokens == [["c"], ["a", "b"]]
+    np.testing.assert_array_equal(surprisals, [2.0, 0.0, 1.0])
+    np.testing.assert_array_equal(offsets, [0, 1, 3])
+    np.testing.assert_array_equal(sidecar.region_surprisals(), [0.0, 1.0, 2.0, 3.0])
+
+
+def test_item_sentence_mapping_json():
+    mapping = ItemSentenceMapping(id=(1, "cond"), region_to_tokens={1: ["a"], 2: []},
+                                  oovs={1: [], 2: ["b"]})
+    assert ItemSentenceMapping.from_json(json.loads(json.dumps(mapping.to_json()))) \
+        == mapping
+
+
+def test_compute_surprisals_single_pass(model, dummy_suite_json):
+    suite_json = _make_suite_json(dummy_suite_json)
+    result = S.compute_surprisals(model, suite_json, single_pass=True)
+
+    assert model.calls["get_surprisals"] == 1
+    assert model.calls["tokenize"] == 0
+    assert result == S.compute_surprisals(WhitespaceModel(), suite_json)
+
+
+def test_iter_compute_surprisals(model, dummy_suite_json, tmp_path):
+    suite_json = _make_suite_json(dummy_suite_json, n_items=5)
+    chunks = list(S.iter_compute_surprisals(model, suite_json, chunk_size=2))
+
+    assert [len(chunk.items) for chunk in chunks] == [2, 2, 1]
+    assert model.calls["get_surprisals"] == 3
+
+    expected = S.compute_surprisals(WhitespaceModel(), suite_json)
+    assert [item for chunk in chunks for item in chunk.items] == expected.items
+
+    # One sidecar file can't hold the outputs of several chunks.
+    with pytest.raises(ValueError):
+        S.iter_compute_surprisals(model, suite_json, chunk_size=2,
+                                  sidecar=tmp_path / "suite.npz")
+
+
+def test_run_models(dummy_suite_json):
+    suites = [_make_suite_json(dummy_suite_json, n_items=n, name="suite%i" % n)
+              for n in (1, 2)]
+    models = {"a": WhitespaceModel(), "b": WhitespaceModel()}
+    result = S.run_models(models, suites, max_workers=2)
+
+    assert result.index.names == ["model", "suite", "prediction_id", "item_number"]
+    for label, model in models.items():
+        assert model.calls["get_surprisals"] == 1
+
+        expected = pd.concat([S.evaluate(suite) for suite in
+                              S.compute_surprisals_many(WhitespaceModel(), suites)])
+        pd.testing.assert_frame_equal(result.loc[label], expected)
+
+    # Without explicit labels, results are labeled by model spec name.
+    result = S.run_models([WhitespaceModel()], suites)
+    assert list(result.index.unique("model")) == [spec["name"]]
+
+
+@pytest.mark.parametrize("executor", [None, "thread"])
+def test_compute_surprisals_sharded(model, dummy_suite_json, tmp_path, executor):
+    if executor == "thread":
+        executor = ThreadPoolExecutor(max_workers=2)
+
+    suite_json = _make_suite_json(dummy_suite_json, n_items=5)
+    cache = SurprisalCache(tmp_path / "cache.sqlite")
+    result = S.compute_surprisals(model, suite_json, shards=3,
+                                  executor=executor, cache=cache)
+
+    expected = S.compute_surprisals(WhitespaceModel(), suite_json)
+    assert [item["item_number"] for item in result.items] == [1, 2, 3, 4, 5]
+    assert result == expected
+
+    # All shards wrote their outputs to the shared cache.
+    model = WhitespaceModel()
+    assert S.compute_surprisals(model, suite_json, cache=cache) == expected
+    assert model.calls["get_surprisals"] == 0
+
+
+def test_import_time():
+    """
+    ``import syntaxgym`` shouldn't pay for the prediction grammar or the
+    async API up front.
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                           "import syntaxgym"],
+                          check=True, capture_output=True, text=True,
+                          cwd=Path(__file__).parent.parent)
+    # Lines look like "import time: self [us] | cumulative | module".
+    modules = {line.rsplit("|", 1)[1].strip()
+               for line in proc.stderr.splitlines()
+               if line.startswith("import time:") and "|" in line}
+    assert "syntaxgym" in modules
+    assert "pyparsing" not in modules
+    assert "asyncio" not in modules
+
+
+def test_async_api(dummy_suite_json):
+    suite_jsons = [_make_suite_json(dummy_suite_json, n_items=n) for n in (1, 2)]
+
+    async def run_all():
+        suites = await asyncio.gather(
+            *[S.compute_surprisals_async(WhitespaceModel(), suite_json)
+              for suite_json in suite_jsons])
+        results = await asyncio.gather(*[S.evaluate_async(suite) for suite in suites])
+        return suites, results
+
+    suites, results = asyncio.run(run_all())
+    for suite_json, suite, result in zip(suite_jsons, suites, results):
+        expected = S.compute_surprisals(WhitespaceModel(), suite_json)
+        assert suite == expected
+        pd.testing.assert_frame_equal(result, S.evaluate(expected))
+
+
+def test_async_options(dummy_suite_json, tmp_path):
+    suite_json = _make_suite_json(dummy_suite_json)
+    sidecar_path = tmp_path / "suite.npz"
+    io_executor = ThreadPoolExecutor(max_workers=2)
+
+    result = asyncio.run(S.compute_surprisals_async(
+        WhitespaceModel(), suite_json, io_executor=io_executor,
+        sidecar=sidecar_path, dedup=False, alignment_workers=1))
+    io_executor.shutdown()
+
+    expected = S.compute_surprisals(WhitespaceModel(), suite_json)
+    assert result == expected
+    assert S.reaggregate(suite_json, sidecar_path) == expected
+
+
+class CheckpointModel(WhitespaceModel):
+    """
+    Whitespace model whose surprisals are scaled by the numeric value of its
+    checkpoint's file name. Call counts are shared across checkpoint clones.
+    """
+
+    shared_calls = Counter()
+
+    def get_result(self, command, sentences=None):
+        self.shared_calls[command] += 1
+        ret = super().get_result(command, sentences)
+        if command == "get_surprisals" and self.checkpoint is not None:
+            ret["surprisal"] *= float(Path(self.checkpoint).name)
+        return ret
+
+
+def test_run_checkpoints(dummy_suite_json, monkeypatch):
+    CheckpointModel.shared_calls.clear()
+    mapping_calls = []
+    compute_sentence_mappings = S.compute_sentence_mappings
+    def mock_compute_sentence_mappings(*args, **kwargs):
+        mapping_calls.append(args)
+        return compute_sentence_mappings(*args, **kwargs)
+    monkeypatch.setattr(S, "compute_sentence_mappings", mock_compute_sentence_mappings)
+
+    suites = [_make_suite_json(dummy_suite_json, n_items=n, name="suite%i" % n)
+              for n in (1, 2)]
+    checkpoints = ["1", "2", "3"]
+    result = S.run_checkpoints(CheckpointModel(), suites, checkpoints)
+
+    assert CheckpointModel.shared_calls["tokenize"] == 1
+    assert CheckpointModel.shared_calls["get_surprisals"] == len(checkpoints)
+    assert len(mapping_calls) == len(suites)
+
+    assert result.index.names == ["checkpoint", "suite", "prediction_id", "item_number"]
+    for checkpoint in checkpoints:
+        model = CheckpointModel().with_checkpoint(checkpoint)
+        expected = pd.concat([S.evaluate(suite) for suite in
+                              S.compute_surprisals_many(model, suites)])
+        pd.testing.assert_frame_equal(result.loc[checkpoint], expected)
+
+
+@pytest.fixture
+def run_cli(dummy_suite_json, tmp_path, monkeypatch):
+    monkeypatch.setattr(commands, "get_registry",
+                        lambda: {"checkpoint-model": CheckpointModel()})
+    suite_path = tmp_path / "suite.json"
+    suite_path.write_text(json.dumps(_make_suite_json(dummy_suite_json)))
+
+    def run_cli(*args):
+        return CliRunner().invoke(
+            commands.syntaxgym,
+            ["run", "checkpoint-model", str(suite_path), *args])
+    return run_cli
+
+
+def test_run_checkpoint_dir(run_cli, tmp_path):
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+    (checkpoint_dir / ".lock").touch()
+
+    # No checkpoints found: don't fall back to the base model.
+    result = run_cli("--checkpoint_dir", str(checkpoint_dir))
+    assert result.exit_code == 2
+    assert "No checkpoints found" in result.output
+
+    # A single checkpoint is still reported as a sweep.
+    (checkpoint_dir / "2").touch()
+    result = run_cli("--checkpoint_dir", str(checkpoint_dir))
+    assert result.exit_code == 0, result.output
+    header = result.output.splitlines()[0].split("\t")
+    assert header[0] == "checkpoint"
+    assert {line.split("\t")[0] for line in result.output.splitlines()[1:]} \
+        == {str(checkpoint_dir / "2")}
+
+    result = run_cli("--checkpoint_dir", str(checkpoint_dir),
+                     "--separate_tokenize")
+    assert result.exit_code == 2
+    assert "not supported with checkpoint sweeps" in result.output
+
+
+def test_run_alignment_workers(run_cli, monkeypatch):
+    expected = run_cli("--checkpoint", "2")
+    monkeypatch.setattr(S.agg_surprisals, "PARALLEL_ALIGNMENT_THRESHOLD", 1)
+    result = run_cli("--checkpoint", "2", "--alignment_workers", "2")
+    assert result.exit_code == 0, result.output
+    assert result.output == expected.output
+
+
+def test_run_single_checkpoint(run_cli):
+    result = run_cli("--checkpoint", "2")
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines()[0].split("\t")[0] == "suite"